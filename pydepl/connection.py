@@ -0,0 +1,180 @@
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Set, Tuple, Union
+
+from fabric import Connection
+
+from .depl_defaults import DEFAULT_CHANNELS_PER_HOST
+from .depl_types import OptDict
+from .remote_helper import RemoteHelper
+
+logger = logging.getLogger(__name__)
+
+
+class ChannelLimiter:
+    # like a BoundedSemaphore, but long lived sessions ( the remote helper ) can take a slot for good
+
+    def __init__(self, limit: int):
+        self.max_limit = limit
+        self.limit = limit
+        self.reserved = 0
+        self.in_use = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while self.in_use >= self.limit:
+                self._cond.wait()
+            self.in_use += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self.in_use -= 1
+            self._cond.notify()
+
+    def reserve(self):
+        # at least one slot is left for the commands, with a limit of 1 the helper goes over it
+        with self._cond:
+            self.reserved += 1
+            self.limit = max(self.max_limit - self.reserved, 1)
+
+    def release(self):
+        # gives back a slot taken by reserve, when the long lived session is gone
+        with self._cond:
+            self.reserved = max(self.reserved - 1, 0)
+            self.limit = max(self.max_limit - self.reserved, 1)
+            self._cond.notify_all()
+
+
+class ConnectionPool:
+    # one authenticated Connection per host, shared by every task running on that host.
+    # each command opens its own exec channel on the connection transport, the number of
+    # channels open at the same time on a host is bounded by the host channel limit
+
+    def __init__(self, channels_per_host: Union[int, Dict[str, int], None] = None,
+                 connection_factory: Callable[..., Connection] = None, remote_helper: bool = False,
+                 helper_factory: Callable[[Connection], RemoteHelper] = None):
+        # connection_factory(host=..., **connection_args) replaces fabric Connection, e.g. with a fake transport
+        self.connection_factory = connection_factory or Connection
+        # with remote_helper commands go through one RemoteHelper per connection instead of a channel each
+        self.remote_helper = remote_helper
+        self.helper_factory = helper_factory or RemoteHelper.over_ssh
+        self._helpers: Dict[int, RemoteHelper] = {}
+        self._helper_locks: Dict[int, threading.Lock] = {}
+        self._helper_failed: Set[int] = set()
+        self._lock = threading.Lock()
+        self._connections: Dict[Tuple[str, str], Connection] = {}
+        self._open_locks: Dict[int, threading.Lock] = {}
+        self._channels: Dict[str, ChannelLimiter] = {}
+        self._host_limits: Dict[str, int] = {}
+        self.default_limit = DEFAULT_CHANNELS_PER_HOST
+        if isinstance(channels_per_host, dict):
+            for host, limit in channels_per_host.items():
+                if host == "default":
+                    self.default_limit = int(limit)
+                else:
+                    self.set_channel_limit(host, limit)
+        elif channels_per_host is not None:
+            self.default_limit = int(channels_per_host)
+        if self.default_limit < 1:
+            raise ValueError(f"Invalid channel limit {self.default_limit}")
+
+    def set_channel_limit(self, host: str, limit: int):
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError(f"Invalid channel limit {limit} for {host=}")
+        with self._lock:
+            if host in self._channels:
+                raise Exception(f"Cannot change the channel limit of {host} while in use")
+            self._host_limits[host] = limit
+
+    def channel_limit(self, host: str) -> int:
+        return self._host_limits.get(host, self.default_limit)
+
+    def get(self, host: str, connection_args: OptDict = None) -> Connection:
+        connection_args = connection_args or {}
+        key = (host, json.dumps(connection_args, sort_keys=True, default=str))
+        with self._lock:
+            conn = self._connections.get(key)
+            if conn is None:
+                conn = self.connection_factory(host=host, **connection_args)
+                self._connections[key] = conn
+        return conn
+
+    def _limiter(self, host: str) -> ChannelLimiter:
+        with self._lock:
+            limiter = self._channels.get(host)
+            if limiter is None:
+                limiter = ChannelLimiter(self.channel_limit(host))
+                self._channels[host] = limiter
+        return limiter
+
+    def _ensure_open(self, conn: Connection):
+        # concurrent tasks must not race to open the transport: that would mean one handshake each
+        with self._lock:
+            open_lock = self._open_locks.setdefault(id(conn), threading.Lock())
+        with open_lock:
+            if not conn.is_connected:
+                logger.debug(f"Opening connection to {conn.host}")
+                conn.open()
+
+    def helper(self, conn: Connection) -> Optional[RemoteHelper]:
+        # returns None when the helper cannot run on the host, callers fall back to conn.run
+        if not self.remote_helper:
+            return None
+        with self._lock:
+            helper_lock = self._helper_locks.setdefault(id(conn), threading.Lock())
+        with helper_lock:
+            if id(conn) in self._helper_failed:
+                return None
+            helper = self._helpers.get(id(conn))
+            if helper is not None and helper.is_closed:
+                # the helper died after it started: same fallback as a failed startup
+                logger.warning(f"Remote helper on {conn.host} has stopped, running commands without it")
+                del self._helpers[id(conn)]
+                self._limiter(conn.host).release()
+                self._helper_failed.add(id(conn))
+                try:
+                    helper.close()
+                except Exception as e:
+                    logger.debug(f"Cannot close stopped remote helper: {e=}")
+                return None
+            if helper is None:
+                logger.debug(f"Starting remote helper on {conn.host}")
+                try:
+                    helper = self.helper_factory(conn)
+                except Exception as e:
+                    logger.warning(f"Cannot start remote helper on {conn.host}, running commands without it: {e=}")
+                    self._helper_failed.add(id(conn))
+                    return None
+                # the helper session stays open, it counts against the host channel limit
+                self._limiter(conn.host).reserve()
+                self._helpers[id(conn)] = helper
+        return helper
+
+    @contextmanager
+    def channel(self, conn: Connection) -> Iterator[Connection]:
+        with self._limiter(conn.host):
+            self._ensure_open(conn)
+            yield conn
+
+    def close(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections = {}
+            self._open_locks = {}
+            self._channels = {}
+            helpers = list(self._helpers.values())
+            self._helpers = {}
+            self._helper_locks = {}
+            self._helper_failed = set()
+        for helper in helpers:
+            helper.close()
+        for conn in connections:
+            conn.close()
+
+
+default_pool = ConnectionPool()
@@ -1,2 +1,13 @@
 LOCAL_IP_ADDR = ['127.0.0.1', 'localhost', 'localhost.localdomain']
 DEFAULT_HOST = '127.0.0.1'
+# same as the OpenSSH MaxSessions default
+DEFAULT_CHANNELS_PER_HOST = 10
+DEFAULT_CONCURRENCY = 1
+# remote helper ( see remote_helper.py )
+DEFAULT_HELPER_PYTHON = 'python3'
+# seconds to wait for the helper ready message before giving up on it
+DEFAULT_HELPER_STARTUP_TIMEOUT = 30
+# the ready message is tiny, a bigger frame means something else is writing on the helper stdout
+HELPER_READY_FRAME_LIMIT = 4096
+# files up to this size are copied through the remote helper, bigger ones use sftp
+HELPER_SMALL_FILE_LIMIT = 1024 * 1024
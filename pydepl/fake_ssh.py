@@ -0,0 +1,256 @@
+import logging
+import posixpath
+import random
+import shlex
+import stat
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from fabric import Result
+
+logger = logging.getLogger(__name__)
+
+# round trips spent by a real ssh client to open a transport (version exchange, kex, auth)
+# and to open an exec channel, run the command and close the channel
+HANDSHAKE_ROUND_TRIPS = 4
+CHANNEL_ROUND_TRIPS = 2
+FAKE_HOME = "/home/fake"
+
+
+class FakeSSHError(OSError):
+    pass
+
+
+def echo_handler(host: str, cmd: str) -> Tuple[str, int]:
+    # default command handler: "echo ..." prints its arguments, everything else succeeds silently
+    try:
+        args = shlex.split(cmd)
+    except ValueError:
+        return "", 2
+    if args and args[0] == "echo":
+        return " ".join(args[1:]) + "\n", 0
+    return "", 0
+
+
+class FakeHostState:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = 0
+        self.peak_sessions = 0
+        self.startups = 0
+        self.files: Dict[str, bytes] = {}
+
+
+class FakeNetwork:
+    """in-process stand-in for a set of ssh servers, use it as the connection_factory
+    of a SimplePipeline or ConnectionPool: every host name resolves to a simulated server"""
+
+    def __init__(self, latency: float = 0.0, bandwidth: Optional[float] = None, failure_rate: float = 0.0,
+                 max_sessions: Optional[int] = 10, max_startups: Optional[int] = None,
+                 handler: Callable[[str, str], Tuple[str, int]] = echo_handler, seed: Optional[int] = None):
+        if not 0.0 <= failure_rate <= 1.0:
+            raise ValueError(f"Invalid {failure_rate=}")
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.max_sessions = max_sessions
+        self.max_startups = max_startups
+        self.handler = handler
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._hosts: Dict[str, FakeHostState] = {}
+        self.stats: Dict[str, int] = {"handshakes": 0, "channels": 0, "failures": 0,
+                                      "rejected": 0, "bytes": 0}
+
+    def __call__(self, host: str, **kwargs) -> "FakeConnection":
+        return FakeConnection(host=host, network=self, **kwargs)
+
+    def host_state(self, host: str) -> FakeHostState:
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None:
+                state = FakeHostState()
+                self._hosts[host] = state
+        return state
+
+    def peak_sessions(self) -> Dict[str, int]:
+        with self._lock:
+            return {host: state.peak_sessions for host, state in self._hosts.items()}
+
+    def _count(self, key: str, value: int = 1):
+        with self._lock:
+            self.stats[key] += value
+
+    def _should_fail(self) -> bool:
+        if not self.failure_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.failure_rate
+
+    def transfer_time(self, size: int) -> float:
+        self._count("bytes", size)
+        return size / self.bandwidth if self.bandwidth else 0.0
+
+    def handshake(self, host: str):
+        state = self.host_state(host)
+        with state.lock:
+            if self.max_startups is not None and state.startups >= self.max_startups:
+                self._count("rejected")
+                raise FakeSSHError(f"{host}: Error reading SSH protocol banner (MaxStartups)")
+            state.startups += 1
+        try:
+            time.sleep(self.latency * HANDSHAKE_ROUND_TRIPS)
+        finally:
+            with state.lock:
+                state.startups -= 1
+        self._count("handshakes")
+
+    def open_session(self, host: str):
+        state = self.host_state(host)
+        with state.lock:
+            if self.max_sessions is not None and state.sessions >= self.max_sessions:
+                self._count("rejected")
+                raise FakeSSHError(f"{host}: ChannelException(1, 'Administratively prohibited')")
+            state.sessions += 1
+            state.peak_sessions = max(state.peak_sessions, state.sessions)
+        self._count("channels")
+
+    def close_session(self, host: str):
+        state = self.host_state(host)
+        with state.lock:
+            state.sessions -= 1
+
+    def execute(self, host: str, cmd: str) -> Tuple[str, int]:
+        self.open_session(host)
+        try:
+            time.sleep(self.latency * CHANNEL_ROUND_TRIPS)
+            if self._should_fail():
+                self._count("failures")
+                raise FakeSSHError(f"{host}: connection reset while running {cmd!r}")
+            stdout, exited = self.handler(host, cmd)
+            time.sleep(self.transfer_time(len(stdout.encode())))
+            return stdout, exited
+        finally:
+            self.close_session(host)
+
+
+class FakeStat:
+
+    def __init__(self, mode: int, size: int = 0):
+        self.st_mode = mode
+        self.st_size = size
+
+
+class FakeSFTP:
+    # the subset of paramiko SFTPClient used by fabric Transfer, files live in memory on the fake host
+
+    def __init__(self, conn: "FakeConnection"):
+        self._conn = conn
+        self._network = conn.network
+        self._state = conn.network.host_state(conn.host)
+
+    def getcwd(self) -> Optional[str]:
+        return None
+
+    def normalize(self, path: str) -> str:
+        return posixpath.normpath(posixpath.join(FAKE_HOME, path))
+
+    def stat(self, path: str) -> FakeStat:
+        path = self.normalize(path)
+        if path == FAKE_HOME:
+            return FakeStat(stat.S_IFDIR | 0o755)
+        with self._state.lock:
+            data = self._state.files.get(path)
+        if data is None:
+            raise FileNotFoundError(path)
+        return FakeStat(stat.S_IFREG | 0o644, size=len(data))
+
+    def chmod(self, path: str, mode: int):
+        self.stat(path)
+
+    def _put_bytes(self, data: bytes, remotepath: str):
+        self._network.open_session(self._conn.host)
+        try:
+            time.sleep(self._network.latency * CHANNEL_ROUND_TRIPS + self._network.transfer_time(len(data)))
+            with self._state.lock:
+                self._state.files[self.normalize(remotepath)] = data
+        finally:
+            self._network.close_session(self._conn.host)
+
+    def _get_bytes(self, remotepath: str) -> bytes:
+        self.stat(remotepath)
+        self._network.open_session(self._conn.host)
+        try:
+            with self._state.lock:
+                data = self._state.files[self.normalize(remotepath)]
+            time.sleep(self._network.latency * CHANNEL_ROUND_TRIPS + self._network.transfer_time(len(data)))
+            return data
+        finally:
+            self._network.close_session(self._conn.host)
+
+    def put(self, localpath: str, remotepath: str):
+        with open(localpath, "rb") as fin:
+            self._put_bytes(fin.read(), remotepath)
+
+    def putfo(self, fl, remotepath: str):
+        self._put_bytes(fl.read(), remotepath)
+
+    def get(self, remotepath: str, localpath: str):
+        data = self._get_bytes(remotepath)
+        with open(localpath, "wb") as fout:
+            fout.write(data)
+
+    def getfo(self, remotepath: str, fl):
+        fl.write(self._get_bytes(remotepath))
+
+
+class FakeConnection:
+    # quacks like fabric Connection for what Task uses: open/close, run, local and sftp
+
+    def __init__(self, host: str, network: FakeNetwork, **kwargs):
+        self.host = host
+        self.network = network
+        self.connect_kwargs = kwargs
+        self._connected = False
+        self._sftp = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def open(self):
+        with self._lock:
+            if self._connected:
+                return
+            self.network.handshake(self.host)
+            self._connected = True
+
+    def close(self):
+        with self._lock:
+            self._connected = False
+            self._sftp = None
+
+    def run(self, command: str, warn: bool = False, **kwargs) -> Result:
+        self.open()
+        stdout, exited = self.network.execute(self.host, command)
+        res = Result(connection=self, command=command, stdout=stdout, stderr="", exited=exited)
+        if exited != 0 and not warn:
+            raise FakeSSHError(f"{self.host}: {command!r} exited with {exited}")
+        return res
+
+    def local(self, command: str, **kwargs) -> Result:
+        stdout, exited = self.network.handler(self.host, command)
+        return Result(connection=self, command=command, stdout=stdout, stderr="", exited=exited)
+
+    def sftp(self) -> FakeSFTP:
+        self.open()
+        with self._lock:
+            if self._sftp is None:
+                self._sftp = FakeSFTP(self)
+        return self._sftp
+
+    def __str__(self) -> str:
+        return f"<FakeConnection host={self.host}>"
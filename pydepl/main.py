@@ -18,6 +18,7 @@ except ImportError:
     sys.path.insert(0, pydepl_root)
 from pydepl.depl_types import OptDict
 from pydepl.pipeline import SimplePipeline
+from pydepl.watch import watch_pipeline
 
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG')
 logger = logging.getLogger(__name__)
@@ -65,6 +66,8 @@ def parse_args(initial_args: OptDict = None, prog_name: str = None, description:
     args: Args = Args(**initial_args)
     p: ArgParser = ArgParser(prog=prog_name, description=description)
     p.add_argument("-p", "--pipeline", help="pipeline file")
+    p.add_argument("-w", "--watch", help="re-run the affected tasks when the pipeline or task inputs change",
+                   action="store_true")
     res = p.parse_args(namespace=args)
     return res
 
@@ -80,7 +83,13 @@ def run_main():
         raise OSError(f"Cannot read pipeline file: {pipeline_file}")
     p: SimplePipeline = SimplePipeline.from_file(file_name=pipeline_file)
     print(f"Found {p.task_number} tasks in {pipeline_file}")
-    p.run()
+    try:
+        if args.watch:
+            watch_pipeline(p, file_name=pipeline_file)
+        else:
+            p.run()
+    finally:
+        p.close()
     # for t in p.task_list:
     #     print(f"Running Task {t}:")
     #     if t.is_dry:
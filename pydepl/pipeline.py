@@ -1,11 +1,15 @@
 import json
 import logging
 import os
+import threading
 import yaml
 from yaml.loader import SafeLoader
-from typing import Union, TextIO
+from typing import Callable, Union, TextIO, Iterable, Set
 from .depl_types import Any, Dict, List, OptDict, Optional
 from .task import Task, TaskResult, TaskType
+from .connection import ConnectionPool
+from .depl_defaults import DEFAULT_CONCURRENCY
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
 from functools import partial
 logger = logging.getLogger(__name__)
 
@@ -13,6 +17,15 @@ logger = logging.getLogger(__name__)
 yaml_open_func = partial(yaml.load, Loader=SafeLoader)
 
 
+class MatrixOutput(dict):
+    # str.format turns {out_var[2]} into an int index, instance keys are always strings
+
+    def __missing__(self, key):
+        if isinstance(key, str):
+            raise KeyError(key)
+        return self[str(key)]
+
+
 class SimplePipeline:
 
     @classmethod
@@ -48,6 +61,9 @@ class SimplePipeline:
             pipeline_version = data.get('version', 1)
             pipeline_context = data.get('context')
             pipeline_task_list = data.get('task_list', [])
+            pipeline_concurrency = data.get('concurrency', DEFAULT_CONCURRENCY)
+            pipeline_channels = data.get('channels_per_host')
+            pipeline_remote_helper = data.get('remote_helper', False)
             task_list = []
             for o in pipeline_task_list:
                 # print(f"[DEBUG] {o=}")
@@ -57,56 +73,265 @@ class SimplePipeline:
                     task_list.append(res)
                 else:
                     print(f"Error cannot create task from json_object: {o}")
-            return SimplePipeline(task_list=task_list, version=pipeline_version, context=pipeline_context)
+            return SimplePipeline(task_list=task_list, version=pipeline_version, context=pipeline_context,
+                                  concurrency=pipeline_concurrency, channels_per_host=pipeline_channels,
+                                  remote_helper=pipeline_remote_helper)
         raise Exception(f"Cannot read from {file_name=}")
 
-    def __init__(self, task_list: Optional[List[Task]] = None, version: int = 1, context: OptDict = None):
+    def __init__(self, task_list: Optional[List[Task]] = None, version: int = 1, context: OptDict = None,
+                 concurrency: int = DEFAULT_CONCURRENCY, channels_per_host: Union[int, Dict[str, int], None] = None,
+                 connection_factory: Callable[..., Any] = None, remote_helper: bool = False):
         self._task_list = task_list or []
+        self.concurrency = max(int(concurrency or 1), 1)
+        self.channels_per_host = channels_per_host
+        self.remote_helper = remote_helper
+        self._connection_factory = connection_factory
+        self._pool = ConnectionPool(channels_per_host=channels_per_host, connection_factory=connection_factory,
+                                    remote_helper=remote_helper)
+        for t in self._task_list:
+            t.connection_pool = self._pool
         self._res_map = {}
+        self._input_map = {}
+        # matrix instances are collected from worker threads
+        self._lock = threading.RLock()
         self.version = version
         self._context = context.copy() if context else {}
+        self._base_context = self._context.copy()
 
     @property
     def raw_context(self):
-        return self._context.copy()
+        with self._lock:
+            return self._context.copy()
 
     @property
     def context(self):
         ctx = self.raw_context
         for key, value in ctx.items():
-            if value.startswith('$'):
+            if isinstance(value, str) and value.startswith('$'):
                 ctx[key] = os.environ.get(value[1:])
         return ctx
 
-    def run(self, exit_on_error: bool = False) -> Dict[str, Any]:
-        print(f"Running Pipeline with {self.context=}")
-        res = None
-        for t in self._task_list:
-            try:
-                if t.is_dry:
-                    # print(f"DryRun!!\n{t.formatted_cmd(with_context=self.context)=}")
-                    # print(f"{t.get_parsed_cmd_args()=}")
-                    logger.info(
-                        f"DryRun, {t.formatted_cmd(with_context=self.context)=}")
-                else:
-                    res = t.run(override_cmds=self.context)
-                    if not res:
-                        logger.warning(f"Task {t} has not produced result")
-                        continue
-                    # print(f"{res=}")
-                    if res.is_invoke_result and res.is_ok:
-                        logger.info(f"[Ok] {res.stdout=}")
-                    if t.task_type == TaskType.SHELLOUT:
-                        logger.debug(f"[SHELLOUT] {res.get_out_var_dict()=}")
+    def _execute_matrix(self, t: Task, context: Dict[str, Any], exit_on_error: bool = False) -> List[str]:
+        # instances are collected as soon as they finish, only the running ones are kept in memory.
+        # the first instance error is raised once the running instances are done
+        parallel = max(int(t.options.get('matrix_parallel', self.concurrency)), 1)
+        with self._lock:
+            # a re-run replaces every instance, the matrix may have shrunk since the last run
+            prefix = f"{t.name}["
+            self._res_map = {k: v for k, v in self._res_map.items() if not k.startswith(prefix)}
+            if t.task_type == TaskType.SHELLOUT:
+                self._context[t.get_task_arg('out_var')] = MatrixOutput()
+        size = t.matrix_size()
+        if size == 0:
+            logger.warning(f"Matrix of {t} is empty, no instance to run")
+            return []
+        logger.info(f"Expanding {t} into {size} instances, {parallel} at a time")
+        input_paths = set()
+        running = {}
+        errors = []
+
+        def drain(return_when, timeout=None):
+            finished, _ = wait(running, timeout=timeout, return_when=return_when)
+            for f in finished:
+                instance = running.pop(f)
+                e = f.exception()
+                if e is not None:
+                    print(f"got Exception {e} for {instance=}")
+                    errors.append(e)
+                    input_paths.update(instance.input_paths(with_context=context))
+                    continue
+                with self._lock:
+                    self._collect(instance, f.result())
+                    input_paths.update(self._input_map.pop(instance.name, []))
+
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            for instance in t.expand():
+                # wait for a free worker, or just pick up the instances already finished
+                drain(FIRST_COMPLETED, timeout=None if len(running) >= parallel else 0)
+                if errors and exit_on_error:
+                    logger.info(f"Not starting the remaining instances of {t}")
+                    break
+                running[executor.submit(self._execute, instance, context)] = instance
+            if running:
+                drain(ALL_COMPLETED)
+        if errors:
+            with self._lock:
+                self._input_map[t.name] = sorted(input_paths)
+            raise errors[0]
+        return sorted(input_paths)
+
+    def _execute(self, t: Task, context: Dict[str, Any], exit_on_error: bool = False) -> Optional[TaskResult]:
+        if t.is_matrix:
+            return self._execute_matrix(t, context, exit_on_error=exit_on_error)
+        if t.is_dry:
+            logger.info(
+                f"DryRun, {t.formatted_cmd(with_context=context)=}")
+            return None
+        return t.run(override_cmds=context)
+
+    def _collect(self, t: Task, res: Optional[TaskResult]):
+        with self._lock:
+            if t.is_matrix:
+                # instances are already collected by _execute_matrix, res holds their input paths
+                self._input_map[t.name] = res
+                return
+            if res is None and not t.is_dry:
+                logger.warning(f"Task {t} has not produced result")
+            else:
+                if res and res.is_invoke_result and res.is_ok:
+                    logger.info(f"[Ok] {res.stdout=}")
+                if res and t.task_type == TaskType.SHELLOUT:
+                    logger.debug(f"[SHELLOUT] {res.get_out_var_dict()=}")
+                    if t.matrix_key is None:
                         self._context.update(**res.get_out_var_dict())
+                    else:
+                        # matrix instances collect their output by instance key: {out_var[key]}
+                        for var, value in res.get_out_var_dict().items():
+                            if not isinstance(self._context.get(var), MatrixOutput):
+                                self._context[var] = MatrixOutput()
+                            self._context[var][t.matrix_key] = value
+                self._res_map[t.name] = res
+            self._input_map[t.name] = t.input_paths(with_context=self.context)
+
+    def _failed(self, t: Task, e: Exception):
+        print(f"got Exception {e} for {t=}")
+        # a failed matrix task has already saved the input paths of its instances
+        if not t.is_matrix:
+            with self._lock:
+                self._input_map[t.name] = t.input_paths(with_context=self.context)
+
+    def dependencies(self, tasks: List[Task]) -> Dict[str, Set[str]]:
+        # a task waits for the earlier tasks producing the out_var it uses and for its depends_on
+        deps = {}
+        producers = {}
+        for t in tasks:
+            deps[t.name] = {producers[v] for v in t.referenced_vars() if v in producers}
+            deps[t.name].update(d for d in t.depends_on if d in deps)
+            if t.task_type == TaskType.SHELLOUT:
+                producers[t.get_task_arg('out_var')] = t.name
+        return deps
+
+    def _run_sequential(self, tasks: List[Task], exit_on_error: bool):
+        for t in tasks:
+            try:
+                res = self._execute(t, self.context, exit_on_error=exit_on_error)
             except Exception as e:
-                print(f"got Exception {e} for {t=}")
+                self._failed(t, e)
                 if exit_on_error:
                     break
             else:
-                self._res_map[t.name] = res
+                self._collect(t, res)
+
+    def _run_concurrent(self, tasks: List[Task], exit_on_error: bool):
+        deps = self.dependencies(tasks)
+        pending = list(tasks)
+        running = {}
+        done = set()
+        stop = False
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while pending or running:
+                if not stop:
+                    for t in [t for t in pending if deps[t.name] <= done]:
+                        pending.remove(t)
+                        running[executor.submit(self._execute, t, self.context, exit_on_error)] = t
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    t = running.pop(f)
+                    done.add(t.name)
+                    e = f.exception()
+                    if e is not None:
+                        self._failed(t, e)
+                        stop = stop or exit_on_error
+                    else:
+                        self._collect(t, f.result())
+
+    def run(self, exit_on_error: bool = False, only: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        print(f"Running Pipeline with {self.context=}")
+        only = set(only) if only is not None else None
+        tasks = []
+        for t in self._task_list:
+            if only is not None and t.name not in only:
+                logger.debug(f"Reusing previous result for {t}")
+                continue
+            tasks.append(t)
+        if self.concurrency > 1:
+            self._run_concurrent(tasks, exit_on_error=exit_on_error)
+        else:
+            self._run_sequential(tasks, exit_on_error=exit_on_error)
         return self._res_map
 
+    def close(self):
+        self._pool.close()
+
+    def input_paths(self) -> Dict[str, List[str]]:
+        return {name: list(paths) for name, paths in self._input_map.items()}
+
+    def downstream_of(self, task_names: Iterable[str]) -> Set[str]:
+        # tasks only see out_var values produced before them, so one ordered pass is enough
+        affected = set(task_names)
+        produced = set()
+        for t in self._task_list:
+            if t.name not in affected and not (t.referenced_vars() & produced) \
+                    and not (set(t.depends_on) & affected):
+                continue
+            affected.add(t.name)
+            if t.task_type == TaskType.SHELLOUT:
+                produced.add(t.get_task_arg('out_var'))
+        return affected
+
+    def affected_by(self, changed_paths: Iterable[str]) -> Set[str]:
+        changed = {os.path.abspath(p) for p in changed_paths}
+        direct = {name for name, paths in self._input_map.items()
+                  if changed.intersection(paths)}
+        return self.downstream_of(direct)
+
+    def update_from(self, other: "SimplePipeline") -> Set[str]:
+        """take the task list of a reloaded pipeline, keeping the results of unchanged tasks,
+        returns the names of the tasks to run again"""
+        if other._base_context != self._base_context:
+            changed = {t.name for t in other.task_list}
+            self._context = other.raw_context
+            self._base_context = other.raw_context
+            self._res_map = {}
+            self._input_map = {}
+        else:
+            old_signatures = {t.name: t.signature() for t in self._task_list}
+            changed = {t.name for t in other.task_list
+                       if old_signatures.get(t.name) != t.signature()}
+            # out_var no longer produced by any task ( removed task or renamed out_var ) leave the context
+            removed_vars = self._out_vars(self._task_list) - self._out_vars(other.task_list)
+            for var in removed_vars:
+                if var in self._base_context:
+                    self._context[var] = self._base_context[var]
+                else:
+                    self._context.pop(var, None)
+            changed.update(t.name for t in other.task_list if t.referenced_vars() & removed_vars)
+        names = {t.name for t in other.task_list}
+        # matrix instances are stored as <task_name>[<key>]
+        self._res_map = {k: v for k, v in self._res_map.items() if k.partition('[')[0] in names}
+        self._input_map = {k: v for k, v in self._input_map.items() if k in names}
+        if (other.channels_per_host, other.remote_helper) != (self.channels_per_host, self.remote_helper):
+            logger.info(f"Connection settings changed to {other.channels_per_host=} {other.remote_helper=}, "
+                        f"reopening the connections")
+            self._pool.close()
+            self._pool = ConnectionPool(channels_per_host=other.channels_per_host,
+                                        connection_factory=self._connection_factory,
+                                        remote_helper=other.remote_helper)
+            self.channels_per_host = other.channels_per_host
+            self.remote_helper = other.remote_helper
+        self._task_list = other.task_list
+        for t in self._task_list:
+            t.connection_pool = self._pool
+        self.version = other.version
+        self.concurrency = other.concurrency
+        return self.downstream_of(changed)
+
+    @staticmethod
+    def _out_vars(tasks: List[Task]) -> Set[str]:
+        return {t.get_task_arg('out_var') for t in tasks if t.task_type == TaskType.SHELLOUT}
+
     @ property
     def task_number(self) -> int:
         return len(self._task_list)
@@ -0,0 +1,305 @@
+import base64
+import itertools
+import json
+import logging
+import os
+import shlex
+import struct
+import subprocess
+import sys
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, BinaryIO, Callable, Dict, Optional
+
+from fabric import Connection, Result
+from fabric.transfer import Result as ScpResult
+from invoke.exceptions import UnexpectedExit
+
+from .depl_defaults import DEFAULT_HELPER_PYTHON, DEFAULT_HELPER_STARTUP_TIMEOUT, HELPER_READY_FRAME_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# every message, in both directions, is a 4 bytes big endian length followed by a utf8 json object
+FRAME_HEADER = struct.Struct(">I")
+
+# sent as the first frame and exec'd by BOOTSTRAP on the remote python, nothing is written to disk.
+# requests are handled in threads so that concurrent tasks on the same host can share the channel
+HELPER_SOURCE = r'''
+import base64, json, os, struct, subprocess, sys, threading
+
+HEADER = struct.Struct(">I")
+rin = sys.stdin.buffer
+wout = sys.stdout.buffer
+wlock = threading.Lock()
+
+
+def read_exact(n):
+    buf = b""
+    while len(buf) < n:
+        data = rin.read(n - len(buf))
+        if not data:
+            return None
+        buf += data
+    return buf
+
+
+def send(msg):
+    data = json.dumps(msg).encode("utf8")
+    with wlock:
+        wout.write(HEADER.pack(len(data)) + data)
+        wout.flush()
+
+
+def handle(req):
+    res = {"id": req.get("id")}
+    try:
+        op = req["op"]
+        if op == "run":
+            env = dict(os.environ)
+            env.update(req.get("env") or {})
+            p = subprocess.run(req["cmd"], shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, env=env, cwd=req.get("cwd"))
+            res["exited"] = p.returncode
+            res["stdout"] = p.stdout.decode("utf8", "replace")
+            res["stderr"] = p.stderr.decode("utf8", "replace")
+        elif op == "put":
+            path = os.path.expanduser(req["path"])
+            with open(path, "wb") as fout:
+                fout.write(base64.b64decode(req["data"]))
+            if req.get("mode") is not None:
+                os.chmod(path, req["mode"])
+            res["path"] = os.path.abspath(path)
+        elif op == "get":
+            path = os.path.expanduser(req["path"])
+            st = os.stat(path)
+            res["path"] = os.path.abspath(path)
+            if req.get("max_size") is not None and st.st_size > req["max_size"]:
+                res["too_large"] = True
+            else:
+                with open(path, "rb") as fin:
+                    res["data"] = base64.b64encode(fin.read()).decode("ascii")
+                res["mode"] = st.st_mode & 0o7777
+        else:
+            res["error"] = "unknown op %r" % op
+    except Exception as e:
+        res["error"] = "%s: %s" % (type(e).__name__, e)
+    send(res)
+
+
+def main():
+    send({"id": 0, "ready": True, "pid": os.getpid()})
+    workers = []
+    while True:
+        header = read_exact(HEADER.size)
+        if header is None:
+            break
+        body = read_exact(HEADER.unpack(header)[0])
+        if body is None:
+            break
+        req = json.loads(body.decode("utf8"))
+        if req.get("op") == "exit":
+            break
+        t = threading.Thread(target=handle, args=(req,))
+        t.start()
+        workers = [w for w in workers if w.is_alive()] + [t]
+    for w in workers:
+        w.join()
+
+
+main()
+'''
+
+BOOTSTRAP = ("import sys,struct;r=sys.stdin.buffer;n=struct.unpack('>I',r.read(4))[0];"
+             "exec(compile(r.read(n),'pydepl_helper','exec'))")
+
+
+class RemoteHelperError(Exception):
+    pass
+
+
+def write_frame(fout: BinaryIO, msg: Dict[str, Any]):
+    data = json.dumps(msg).encode("utf8")
+    fout.write(FRAME_HEADER.pack(len(data)) + data)
+    fout.flush()
+
+
+def read_frame(fin: BinaryIO, max_size: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    header = fin.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    size = FRAME_HEADER.unpack(header)[0]
+    if max_size is not None and size > max_size:
+        raise RemoteHelperError(f"Invalid frame of {size} bytes, starting with {header!r}")
+    data = fin.read(size)
+    while len(data) < size:
+        more = fin.read(size - len(data))
+        if not more:
+            return None
+        data += more
+    return json.loads(data.decode("utf8"))
+
+
+class RemoteHelper:
+    """client side of the helper: one long running python process per host, started once,
+    that runs commands and copies small files on behalf of the tasks over a single channel"""
+
+    @classmethod
+    def over_ssh(cls, conn: Connection, python: str = DEFAULT_HELPER_PYTHON,
+                 startup_timeout: float = DEFAULT_HELPER_STARTUP_TIMEOUT) -> "RemoteHelper":
+        if not conn.is_connected:
+            conn.open()
+        chan = conn.client.get_transport().open_session()
+        try:
+            chan.exec_command(f"{python} -u -c {shlex.quote(BOOTSTRAP)}")
+
+            def read_stderr() -> str:
+                return chan.makefile_stderr("rb").read().decode("utf8", "replace") if chan.recv_stderr_ready() else ""
+
+            return cls(reader=chan.makefile("rb"), writer=chan.makefile_stdin("wb"), close_func=chan.close,
+                       connection=conn, stderr_func=read_stderr, timeout_func=chan.settimeout,
+                       startup_timeout=startup_timeout)
+        except Exception as e:
+            chan.close()
+            if isinstance(e, RemoteHelperError):
+                raise
+            raise RemoteHelperError(f"Cannot start remote helper on {conn.host}: {e=}") from e
+
+    @classmethod
+    def local(cls, python: str = sys.executable) -> "RemoteHelper":
+        # same helper in a local subprocess, handy for tests
+        proc = subprocess.Popen([python, "-u", "-c", BOOTSTRAP], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        def close_proc():
+            proc.wait(timeout=10)
+
+        try:
+            return cls(reader=proc.stdout, writer=proc.stdin, close_func=close_proc)
+        except Exception:
+            proc.kill()
+            proc.wait()
+            raise
+
+    def __init__(self, reader: BinaryIO, writer: BinaryIO, close_func: Callable[[], Any] = None,
+                 connection: Connection = None, stderr_func: Callable[[], str] = None,
+                 timeout_func: Callable[[Optional[float]], Any] = None,
+                 startup_timeout: float = DEFAULT_HELPER_STARTUP_TIMEOUT):
+        # timeout_func sets the read timeout of the reader ( e.g. Channel.settimeout ), used for the handshake only
+        self.connection = connection
+        self._reader = reader
+        self._writer = writer
+        self._close_func = close_func
+        self._write_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending: Dict[int, Future] = {}
+        self._ids = itertools.count(1)
+        self._closed = False
+        source = HELPER_SOURCE.encode("utf8")
+        self._writer.write(FRAME_HEADER.pack(len(source)) + source)
+        self._writer.flush()
+        if timeout_func:
+            timeout_func(startup_timeout)
+        try:
+            # a login script writing on stdout would be read as a frame: only a small ready message is accepted
+            ready = read_frame(self._reader, max_size=HELPER_READY_FRAME_LIMIT)
+        except (OSError, ValueError) as e:
+            # socket.timeout is an OSError, a garbled frame is a ValueError ( json or utf8 )
+            raise RemoteHelperError(f"No ready message from remote helper: {e=}") from e
+        if not isinstance(ready, dict) or ready.get("id") != 0 or ready.get("ready") is not True:
+            stderr = stderr_func() if stderr_func else ""
+            raise RemoteHelperError(f"Cannot start remote helper: {stderr or ready}")
+        if timeout_func:
+            timeout_func(None)
+        self.pid = ready.get("pid")
+        logger.debug(f"Remote helper started with pid {self.pid}")
+        self._reader_thread = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader_thread.start()
+
+    @property
+    def is_closed(self) -> bool:
+        # set once the helper output is closed: the process exited or the channel dropped
+        with self._pending_lock:
+            return self._closed
+
+    def _read_loop(self):
+        error = None
+        try:
+            while True:
+                msg = read_frame(self._reader)
+                if msg is None:
+                    break
+                with self._pending_lock:
+                    future = self._pending.pop(msg.get("id"), None)
+                if future is not None:
+                    future.set_result(msg)
+        except Exception as e:
+            error = e
+        with self._pending_lock:
+            pending = list(self._pending.values())
+            self._pending = {}
+            self._closed = True
+        for future in pending:
+            future.set_exception(RemoteHelperError(f"Remote helper channel closed: {error=}"))
+
+    def request(self, op: str, timeout: Optional[float] = None, **kwargs) -> Dict[str, Any]:
+        future = Future()
+        with self._pending_lock:
+            if self._closed:
+                raise RemoteHelperError("Remote helper is closed")
+            req_id = next(self._ids)
+            self._pending[req_id] = future
+        try:
+            with self._write_lock:
+                write_frame(self._writer, dict(kwargs, id=req_id, op=op))
+            res = future.result(timeout=timeout)
+        except (OSError, ValueError, FutureTimeoutError) as e:
+            with self._pending_lock:
+                self._pending.pop(req_id, None)
+            raise RemoteHelperError(f"Remote helper request {op} failed: {e=}") from e
+        if "error" in res:
+            raise RemoteHelperError(res["error"])
+        return res
+
+    def run(self, cmd: str, env: Optional[Dict[str, str]] = None, cwd: Optional[str] = None, warn: bool = False,
+            timeout: Optional[float] = None) -> Result:
+        # like Connection.run the command may run for as long as it needs unless a timeout is given
+        res = self.request("run", timeout=timeout, cmd=cmd, env=env, cwd=cwd)
+        result = Result(connection=self.connection, command=cmd, stdout=res["stdout"], stderr=res["stderr"],
+                        exited=res["exited"])
+        # same behaviour as Connection.run
+        if result.exited != 0 and not warn:
+            raise UnexpectedExit(result)
+        return result
+
+    def put(self, local: str, remote: str, preserve_mode: bool = True) -> ScpResult:
+        with open(local, "rb") as fin:
+            data = base64.b64encode(fin.read()).decode("ascii")
+        mode = os.stat(local).st_mode & 0o7777 if preserve_mode else None
+        res = self.request("put", path=remote, data=data, mode=mode)
+        return ScpResult(orig_remote=remote, remote=res["path"], orig_local=local, local=os.path.abspath(local),
+                         connection=self.connection)
+
+    def get(self, remote: str, local: str, max_size: Optional[int] = None,
+            preserve_mode: bool = True) -> Optional[ScpResult]:
+        # returns None when the remote file is bigger than max_size
+        res = self.request("get", path=remote, max_size=max_size)
+        if res.get("too_large"):
+            return None
+        local_dir = os.path.dirname(os.path.abspath(local))
+        os.makedirs(local_dir, exist_ok=True)
+        with open(local, "wb") as fout:
+            fout.write(base64.b64decode(res["data"]))
+        if preserve_mode:
+            os.chmod(local, res["mode"])
+        return ScpResult(orig_remote=remote, remote=res["path"], orig_local=local, local=os.path.abspath(local),
+                         connection=self.connection)
+
+    def close(self):
+        if not self.is_closed:
+            try:
+                with self._write_lock:
+                    write_frame(self._writer, {"op": "exit"})
+                self._writer.close()
+            except (OSError, ValueError) as e:
+                logger.debug(f"Cannot stop remote helper cleanly: {e=}")
+        if self._close_func:
+            self._close_func()
@@ -1,16 +1,20 @@
 from __future__ import annotations
-from typing import Union, Dict, List
+from typing import Union, Dict, List, Set, Iterator, Optional, Sequence, Tuple
 from fabric import Connection, Result
 from fabric.executor import invoke
 from fabric.transfer import Result as ScpResult
 from fabric.transfer import Transfer
 from enum import Enum, unique
 from .depl_types import OptDict, Any, Dict
-from .depl_defaults import LOCAL_IP_ADDR, DEFAULT_HOST
+from .depl_defaults import LOCAL_IP_ADDR, DEFAULT_HOST, HELPER_SMALL_FILE_LIMIT
 from .utils import parse_variable, is_local_addr
+from .connection import ConnectionPool, default_pool
 import os
 import json
 import logging
+import re
+import shlex
+import math
 import yaml
 from yaml.loader import SafeLoader
 from functools import partial
@@ -20,6 +24,16 @@ from string import Formatter
 logger = logging.getLogger(__name__)
 
 
+def _lazy_product(axes: List[Sequence[Any]]) -> Iterator[Tuple[Any, ...]]:
+    # unlike itertools.product this never turns the axes (e.g. a large range) into tuples
+    if not axes:
+        yield ()
+        return
+    for value in axes[0]:
+        for rest in _lazy_product(axes[1:]):
+            yield (value,) + rest
+
+
 class TaskResult:
 
     def __init__(self, invoke_result: Union[Result, ScpResult], is_ok: bool = False, exception: Exception = None):
@@ -124,6 +138,8 @@ class Task:
             for task_arg in ["out_var", "dest"]:
                 task_args[task_arg] = parse_variable(
                     data.get(task_arg), context=parse_context)
+            task_args["depends_on"] = data.get("depends_on") or []
+            task_args["matrix"] = data.get("matrix")
             if task_cmd_args:
                 for key, value in task_cmd_args.items():
                     task_cmd_args[key] = parse_variable(
@@ -155,6 +171,8 @@ class Task:
             for task_arg in ["out_var", "dest"]:
                 task_args[task_arg] = parse_variable(
                     data.get(task_arg), context=parse_context)
+            task_args["depends_on"] = data.get("depends_on") or []
+            task_args["matrix"] = data.get("matrix")
             if task_cmd_args:
                 for key, value in task_cmd_args.items():
                     task_cmd_args[key] = parse_variable(
@@ -176,8 +194,14 @@ class Task:
         self._parsed_cmd_args = None
         self._task_args = {}
         self._connection = None
+        self.connection_pool: ConnectionPool = None
+        self.matrix_key: Optional[str] = None
+        self.matrix_values: Dict[str, Any] = {}
         if kwargs:
             self._task_args.update(**kwargs)
+        matrix = self.get_task_arg('matrix')
+        if matrix is not None and (isinstance(matrix, bool) or not isinstance(matrix, (int, list, dict))):
+            raise Exception(f"Task {self.name} matrix must be an integer, a list or a mapping of lists")
         if self.task_type == TaskType.SHELLOUT and not self.get_task_arg('out_var'):
             raise Exception(
                 f"Task of type {self.task_type} must have a \"out_var\" variable")
@@ -201,10 +225,13 @@ class Task:
             return [item[1] for item in self._parsed_cmd_args]
         return []
 
+    def get_connection_pool(self) -> ConnectionPool:
+        return self.connection_pool or default_pool
+
     def _get_connection(self) -> Connection:
         if not self._connection:
-            self._connection = Connection(
-                host=self.host, **self.connection_args)
+            self._connection = self.get_connection_pool().get(
+                host=self.host, connection_args=self.connection_args)
         return self._connection
 
     def get_connection(self) -> Connection:
@@ -215,6 +242,7 @@ class Task:
         cmd_args.update(**self.cmd_args)
         if override_args:
             cmd_args.update(**override_args)
+        cmd_args.update(**self.matrix_values)
         return cmd_args
 
     def build_cmd(self, override_args: OptDict = None) -> str:
@@ -224,11 +252,115 @@ class Task:
         cmd = cmd_base.format(**(cmd_args))
         return cmd
 
+    @property
+    def depends_on(self) -> List[str]:
+        depends_on = self.get_task_arg('depends_on') or []
+        return [depends_on] if isinstance(depends_on, str) else list(depends_on)
+
+    @property
+    def is_matrix(self) -> bool:
+        # an empty matrix ( [], 0 ) is still a matrix, it expands to no instance
+        return self.get_task_arg('matrix') is not None
+
+    def matrix_axes(self) -> List[Tuple[str, Sequence[Any]]]:
+        matrix = self.get_task_arg('matrix')
+        if matrix is None:
+            return []
+        if isinstance(matrix, int):
+            return [("item", range(matrix))]
+        if isinstance(matrix, list):
+            return [("item", matrix)]
+        axes = []
+        for axis, values in matrix.items():
+            if isinstance(values, int):
+                values = range(values)
+            elif not isinstance(values, list):
+                values = [values]
+            axes.append((axis, values))
+        return axes
+
+    def matrix_size(self) -> int:
+        axes = self.matrix_axes()
+        if not axes:
+            return 0
+        return math.prod(len(values) for _, values in axes)
+
+    def expand(self) -> Iterator["Task"]:
+        # instances are built one at a time while the pipeline consumes them
+        axes = self.matrix_axes()
+        if not axes:
+            return
+        names = [axis for axis, _ in axes]
+        task_args = {k: v for k, v in self._task_args.items() if k != 'matrix'}
+        for values in _lazy_product([v for _, v in axes]):
+            overlay = dict(zip(names, values))
+            if len(values) == 1:
+                key = str(values[0])
+            else:
+                key = ",".join(f"{k}={v}" for k, v in overlay.items())
+            instance = Task(name=f"{self.name}[{key}]", cmd=self.cmd, host=self.host,
+                            cmd_args=self.cmd_args, connection_args=self.connection_args,
+                            options=self.options, task_type=self.task_type, **task_args)
+            instance.matrix_key = key
+            instance.matrix_values = overlay
+            instance.connection_pool = self.connection_pool
+            yield instance
+
+    def referenced_vars(self) -> Set[str]:
+        if not self.cmd:
+            return set()
+        # {deployed[web]} and {obj.attr} read the variable deployed / obj
+        return {re.split(r"[.\[]", item[1], maxsplit=1)[0] for item in Formatter().parse(self.cmd) if item[1]}
+
+    def input_paths(self, with_context: OptDict = None) -> List[str]:
+        """local paths read by this task: the scp source when copying to a remote host,
+        or the file arguments of a local shell command"""
+        try:
+            cmd = self.build_cmd(override_args=with_context)
+        except (KeyError, IndexError, ValueError):
+            return []
+        if self.task_type == TaskType.SCP:
+            if is_local_addr(self.get_task_arg('dest')):
+                return []
+            candidates = [cmd]
+        elif self.is_local:
+            try:
+                candidates = shlex.split(cmd)
+            except ValueError:
+                return []
+        else:
+            return []
+        return [os.path.abspath(c) for c in candidates if os.path.isfile(c)]
+
+    def signature(self) -> tuple:
+        return (self.name, self.host, self.cmd, json.dumps(self.cmd_args, sort_keys=True, default=str),
+                json.dumps(self.options, sort_keys=True, default=str), self.task_type,
+                json.dumps(self._task_args, sort_keys=True, default=str))
+
     def _run(self, conn: Connection, cmd: str) -> TaskResult:
         if self.is_local:
             return TaskResult(conn.local(cmd))
         else:
-            return TaskResult(conn.run(cmd))
+            pool = self.get_connection_pool()
+            with pool.channel(conn):
+                helper = pool.helper(conn)
+                if helper is not None:
+                    return TaskResult(helper.run(cmd))
+                return TaskResult(conn.run(cmd))
+
+    def _helper_get(self, conn: Connection, remote: str, local: str) -> Optional[ScpResult]:
+        helper = self.get_connection_pool().helper(conn)
+        if helper is None:
+            return None
+        return helper.get(remote=remote, local=local, max_size=HELPER_SMALL_FILE_LIMIT)
+
+    def _helper_put(self, conn: Connection, local: str, remote: str) -> Optional[ScpResult]:
+        if os.path.getsize(local) > HELPER_SMALL_FILE_LIMIT:
+            return None
+        helper = self.get_connection_pool().helper(conn)
+        if helper is None:
+            return None
+        return helper.put(local=local, remote=remote)
 
     def formatted_cmd(self, with_context: OptDict = None) -> str:
         cmd = self.build_cmd(override_args=with_context)
@@ -254,8 +386,9 @@ class Task:
                             f"Invoking scp task with {cmd=}(remote), local={os.path.join(b_args.get('destdir','.'),cmd)}")
                         # you can't do that, ScpResult has no ok or stderr/stdin behaviour
                         # if an Exception is raised then it will ko else consider it ok
-                        scp_res = t.get(remote=cmd,
-                                        local=os.path.join(b_args.get('destdir', "."), cmd))
+                        local = os.path.join(b_args.get('destdir', "."), cmd)
+                        with self.get_connection_pool().channel(c):
+                            scp_res = self._helper_get(c, remote=cmd, local=local) or t.get(remote=cmd, local=local)
                         res = TaskResult(invoke_result=scp_res, is_ok=True)
                     # except OSError as e:
                     #     logger.error(
@@ -267,8 +400,11 @@ class Task:
                 else:
                     try:
                         logger.info(f"Invoking scp from {self.host} to {dest}")
-                        res = TaskResult(invoke_result=t.put(local=cmd,
-                                                             remote=cmd))
+                        # uploads go over the connection to dest, not to the (local) origin host
+                        dest_conn = self.get_connection_pool().get(host=dest, connection_args=self.connection_args)
+                        with self.get_connection_pool().channel(dest_conn):
+                            res = TaskResult(invoke_result=self._helper_put(dest_conn, local=cmd, remote=cmd) or
+                                             Transfer(dest_conn).put(local=cmd, remote=cmd), is_ok=True)
                     except OSError as e:
                         logger.error(f"OsError while copying {cmd}: {e=}")
                     except Exception as e:
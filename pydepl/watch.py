@@ -0,0 +1,168 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from typing import Iterable, List, Optional, Set
+
+from .pipeline import SimplePipeline
+
+logger = logging.getLogger(__name__)
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class PollingWatcher:
+    # fallback when inotify is not available: compare mtimes every interval
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._mtimes = {}
+
+    def _mtime(self, path: str) -> Optional[float]:
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def set_paths(self, paths: Iterable[str]):
+        # known paths keep the mtime seen before the last run, a file saved during the run is still a change
+        self._mtimes = {p: self._mtimes[p] if p in self._mtimes else self._mtime(p) for p in paths}
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            changed = {p for p, m in self._mtimes.items() if self._mtime(p) != m}
+            if changed:
+                for p in changed:
+                    self._mtimes[p] = self._mtime(p)
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            time.sleep(self.interval)
+
+    def close(self):
+        self._mtimes = {}
+
+
+class InotifyWatcher:
+    # watches the parent directories, editors often replace files instead of writing them in place
+
+    def __init__(self, libc: ctypes.CDLL):
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._paths = set()
+        self._wd_map = {}
+
+    def set_paths(self, paths: Iterable[str]):
+        self._paths = {os.path.abspath(p) for p in paths}
+        dirs = {os.path.dirname(p) for p in self._paths}
+        for wd, d in list(self._wd_map.items()):
+            if d not in dirs:
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._wd_map[wd]
+        for d in dirs - set(self._wd_map.values()):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(d), WATCH_MASK)
+            if wd < 0:
+                logger.warning(f"Cannot watch directory {d}")
+                continue
+            self._wd_map[wd] = d
+
+    def _read_events(self) -> Set[str]:
+        changed = set()
+        try:
+            buf = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(buf):
+            wd, _mask, _cookie, name_len = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + name_len].rstrip(b"\0")
+            offset += name_len
+            d = self._wd_map.get(wd)
+            if d is None:
+                continue
+            path = os.path.join(d, os.fsdecode(name))
+            if path in self._paths:
+                changed.add(path)
+        return changed
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        changed = set()
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        while ready:
+            changed |= self._read_events()
+            # collect the burst of events a single save usually produces
+            ready, _, _ = select.select([self._fd], [], [], 0.1)
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def get_watcher(interval: float = 0.5):
+    libc_name = ctypes.util.find_library("c")
+    if libc_name:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if hasattr(libc, "inotify_init1"):
+            try:
+                return InotifyWatcher(libc)
+            except OSError as e:
+                logger.warning(f"Cannot use inotify, falling back to polling: {e=}")
+    return PollingWatcher(interval=interval)
+
+
+def watched_paths(pipeline: SimplePipeline, file_name: str) -> List[str]:
+    paths = {os.path.abspath(file_name)}
+    for task_paths in pipeline.input_paths().values():
+        paths.update(task_paths)
+    return sorted(paths)
+
+
+def watch_pipeline(pipeline: SimplePipeline, file_name: str, exit_on_error: bool = False, interval: float = 0.5):
+    file_name = os.path.abspath(file_name)
+    watcher = get_watcher(interval=interval)
+    logger.info(f"Watching {file_name} with {type(watcher).__name__}")
+    # the task inputs are only known after the first run, the pipeline file is watched from the start
+    watcher.set_paths([file_name])
+    pipeline.run(exit_on_error=exit_on_error)
+    try:
+        while True:
+            watcher.set_paths(watched_paths(pipeline, file_name))
+            changed = watcher.wait()
+            if not changed:
+                continue
+            logger.info(f"Changed: {sorted(changed)}")
+            affected = set()
+            if file_name in changed:
+                try:
+                    reloaded = SimplePipeline.from_file(file_name=file_name)
+                except Exception as e:
+                    logger.error(f"Cannot reload pipeline {file_name}: {e=}")
+                    continue
+                affected |= pipeline.update_from(reloaded)
+            affected |= pipeline.affected_by(changed - {file_name})
+            if not affected:
+                logger.info("No task affected")
+                continue
+            logger.info(f"Re-running {sorted(affected)}")
+            pipeline.run(exit_on_error=exit_on_error, only=affected)
+    except KeyboardInterrupt:
+        logger.info("Stop watching")
+    finally:
+        watcher.close()
@@ -1,15 +1,23 @@
-from typing import Union, TextIO, Sequence, Optional
+from typing import Union, TextIO, BinaryIO, Sequence, Optional, Iterator, Callable
 import argparse
 import base64
+import binascii
+import codecs
 import json
+import mmap
 import os
 import sys
+from multiprocessing import Pool
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey, RSAPublicKey
 Parser = argparse.ArgumentParser
 Args = argparse.Namespace
 ParserError = argparse.ArgumentError
+# input bytes per chunk when encoding ( multiple of 3 ) and input chars per chunk when decoding ( multiple of 4 )
+DEFAULT_ENCODE_CHUNK = 3 * 1024 * 1024
+DEFAULT_DECODE_CHUNK = 4 * 1024 * 1024
+WHITESPACE = b" \t\r\n"
 
 
 def generate_private_key(key_size: int = 2048, public_exponent=65537) -> RSAPrivateKey:
@@ -52,7 +60,22 @@ def base64_decode(data: bytes, url_variant: bool = False) -> bytes:
     return decode_func(data)
 
 
-def write_output(data: Sequence[Union[bytes, str]], out_device: Union[str, TextIO], format: str = "txt"):
+def json_key(decode: bool = False, url_variant: bool = False) -> str:
+    # both the string and the stream mode write {"<key>": "<data>"}
+    return "decoded" if decode else ("base64url" if url_variant else "base64")
+
+
+def write_output(data: Sequence[Union[bytes, str]], out_device: Union[str, TextIO], format: str = "txt",
+                 key: str = "base64"):
+    if format == "json":
+        value = data[-1].decode("ascii") if isinstance(data[-1], bytes) else data[-1]
+        payload = json.dumps({key: value}) + "\n"
+        if isinstance(out_device, str):
+            with open(out_device, "w") as fout:
+                fout.write(payload)
+        else:
+            out_device.write(payload)
+        return
     if isinstance(out_device, str):
         with open(out_device, "w") as woout:
             woout.writelines(f"{d}\n" if isinstance(
@@ -62,35 +85,180 @@ def write_output(data: Sequence[Union[bytes, str]], out_device: Union[str, TextI
             d, str) else str(d) for d in data)
 
 
+def align_chunk_size(chunk_size: int, block: int) -> int:
+    return max(chunk_size - chunk_size % block, block)
+
+
+def iter_chunks(fin: Union[BinaryIO, mmap.mmap], chunk_size: int) -> Iterator[Union[bytes, memoryview]]:
+    # every chunk but the last one is exactly chunk_size long, short reads ( pipes ) are joined
+    if isinstance(fin, mmap.mmap):
+        view = memoryview(fin)
+        try:
+            for offset in range(0, len(view), chunk_size):
+                yield view[offset:offset + chunk_size]
+        finally:
+            view.release()
+        return
+    buf = b""
+    while True:
+        data = fin.read(chunk_size - len(buf))
+        if not data:
+            break
+        buf += data
+        if len(buf) == chunk_size:
+            yield buf
+            buf = b""
+    if buf:
+        yield buf
+
+
+def _encode_chunk(args) -> bytes:
+    chunk, url_variant = args
+    return base64_encode(chunk, url_variant=url_variant)
+
+
+_worker_map = None
+
+
+def _init_worker(file_name: Optional[str]):
+    global _worker_map
+    if file_name:
+        with open(file_name, "rb") as fin:
+            _worker_map = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _encode_range(args) -> bytes:
+    offset, length, url_variant = args
+    return base64_encode(memoryview(_worker_map)[offset:offset + length], url_variant=url_variant)
+
+
+def encode_stream(fin: Union[BinaryIO, mmap.mmap], write: Callable[[bytes], object], chunk_size: int = DEFAULT_ENCODE_CHUNK,
+                  url_variant: bool = False, jobs: int = 1, file_name: Optional[str] = None):
+    chunk_size = align_chunk_size(chunk_size, 3)
+    if jobs <= 1:
+        for chunk in iter_chunks(fin, chunk_size):
+            write(base64_encode(chunk, url_variant=url_variant))
+        return
+    # hand out jobs chunks at a time so that memory stays bounded by jobs * chunk_size
+    mapped = isinstance(fin, mmap.mmap) and file_name is not None
+    with Pool(processes=jobs, initializer=_init_worker, initargs=(file_name if mapped else None,)) as pool:
+        if mapped:
+            ranges = [(offset, chunk_size, url_variant) for offset in range(0, len(fin), chunk_size)]
+            for start in range(0, len(ranges), jobs):
+                for encoded in pool.map(_encode_range, ranges[start:start + jobs]):
+                    write(encoded)
+            return
+        batch = []
+        for chunk in iter_chunks(fin, chunk_size):
+            batch.append((chunk, url_variant))
+            if len(batch) == jobs:
+                for encoded in pool.map(_encode_chunk, batch):
+                    write(encoded)
+                batch = []
+        for encoded in pool.map(_encode_chunk, batch):
+            write(encoded)
+
+
+def decode_stream(fin: Union[BinaryIO, mmap.mmap], write: Callable[[bytes], object], chunk_size: int = DEFAULT_DECODE_CHUNK,
+                  url_variant: bool = False):
+    chunk_size = align_chunk_size(chunk_size, 4)
+    pending = b""
+    for chunk in iter_chunks(fin, chunk_size):
+        # line breaks ( base64 -w 76 ) are allowed anywhere, only complete 4 chars groups are decoded
+        data = pending + bytes(chunk).translate(None, WHITESPACE)
+        cut = len(data) - len(data) % 4
+        pending = data[cut:]
+        if cut:
+            write(base64_decode(data[:cut], url_variant=url_variant))
+    if pending:
+        raise binascii.Error(f"Truncated base64 input, {len(pending)} trailing characters")
+
+
+def open_input(input_file: str, use_mmap: bool = False) -> Union[BinaryIO, mmap.mmap]:
+    if input_file == "-":
+        return sys.stdin.buffer
+    fin = open(input_file, "rb")
+    if use_mmap and os.fstat(fin.fileno()).st_size > 0:
+        try:
+            return mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            # the mapping stays valid after the file is closed
+            fin.close()
+    return fin
+
+
+def run_stream(args: Args):
+    fin = open_input(args.input, use_mmap=args.mmap)
+    fout = open(args.output, "wb") if isinstance(args.output, str) else sys.stdout.buffer
+    try:
+        write = fout.write
+        if args.format == "json" and args.decode:
+            # decoded data is written as a json string, multibyte chars may be split between chunks
+            text_decoder = codecs.getincrementaldecoder(args.encoding)()
+
+            def write(data: bytes):
+                fout.write(json.dumps(text_decoder.decode(data))[1:-1].encode("utf8"))
+        if args.format == "json":
+            fout.write(f'{{"{json_key(args.decode, args.url)}": "'.encode("utf8"))
+        if args.decode:
+            decode_stream(fin, write, chunk_size=args.chunk_size or DEFAULT_DECODE_CHUNK, url_variant=args.url)
+            if args.format == "json":
+                fout.write(json.dumps(text_decoder.decode(b"", final=True))[1:-1].encode("utf8"))
+        else:
+            encode_stream(fin, write, chunk_size=args.chunk_size or DEFAULT_ENCODE_CHUNK, url_variant=args.url,
+                          jobs=args.jobs, file_name=args.input if args.mmap and args.input != "-" else None)
+        fout.write(b'"}\n' if args.format == "json" else (b"\n" if not args.decode else b""))
+    finally:
+        if fin is not sys.stdin.buffer:
+            fin.close()
+        if fout is not sys.stdout.buffer:
+            fout.close()
+        else:
+            fout.flush()
+
+
 def parse_args():
     p: Parser = Parser()
     cmd_group = p.add_argument_group()
     p.add_argument(
         "-u", "--url", help="use base64 url friendly variant", action='store_true')
+    p.add_argument("-d", "--decode", help="decode instead of encoding", action='store_true')
     p.add_argument("-e", "--encoding",
                    help="string encoding format ( default utf-8 )", default="utf8")
     p.add_argument(
         "-o", "--output", help="output to write to (default stdout)", default=sys.stdout)
     p.add_argument("-f", "--format", help="output format",
-                   choices=("txt", "json"))
-    p.add_argument("input_data", help="string to b64encode")
-    return p.parse_args()
+                   choices=("txt", "json"), default="txt")
+    p.add_argument("-i", "--input", help="file to stream in chunks instead of input_data ( - for stdin )")
+    p.add_argument("-c", "--chunk-size", help="chunk size in bytes ( rounded to a multiple of 3, 4 when decoding )",
+                   type=int)
+    p.add_argument("-j", "--jobs", help="processes encoding chunks in parallel", type=int, default=1)
+    p.add_argument("-m", "--mmap", help="memory map the input file", action='store_true')
+    p.add_argument("input_data", help="string to b64encode", nargs="?")
+    args = p.parse_args()
+    if (args.input is None) == (args.input_data is None):
+        p.error("provide either input_data or --input")
+    if args.jobs > 1 and args.decode:
+        p.error("--jobs is supported only when encoding")
+    return args
 
 
 def run_main():
     args = parse_args()
+    if args.input is not None:
+        run_stream(args)
+        return
     data_str: str = args.input_data
     data_encoding = args.encoding
-    data = data_str.encode(encoding=data_encoding)
-    b64_data = base64_encode(data=data, url_variant=args.url)
-    b64_data_str = b64_data.decode(encoding=data_encoding)
-    write_output(data=[b64_data, b64_data_str], out_device=sys.stdout)
-    # if not args.output or args.output == sys.stdout:
-    #     print(f"{b64_data=}\n{b64_data_str=}")
-    # else:
-    #     print(f"Writing to file {args.output}")
-    #     with open(args.output, "w") as fout:
-    #         fout.write(f"{b64_data=}\n{b64_data_str=}")
+    if args.decode:
+        data = base64_decode(data=data_str.encode("ascii"), url_variant=args.url)
+        result = [data.decode(encoding=data_encoding)]
+    else:
+        data = data_str.encode(encoding=data_encoding)
+        b64_data = base64_encode(data=data, url_variant=args.url)
+        b64_data_str = b64_data.decode(encoding=data_encoding)
+        result = [b64_data_str] if args.format == "json" else [b64_data, b64_data_str]
+    write_output(data=result, out_device=args.output, format=args.format, key=json_key(args.decode, args.url))
 
 
 if __name__ == "__main__":
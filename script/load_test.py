@@ -0,0 +1,122 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Sequence
+
+# make it work when pydepl is not installed and is not in PYTHONPATH
+try:
+    import pydepl
+except ImportError:
+    pydepl_root = os.path.join(os.path.dirname(__file__), os.path.pardir)
+    sys.path.insert(0, pydepl_root)
+
+from pydepl.fake_ssh import FakeNetwork
+from pydepl.pipeline import SimplePipeline
+from pydepl.task import Task, TaskResult, TaskType
+
+Parser = argparse.ArgumentParser
+Args = argparse.Namespace
+
+
+class TimedTask(Task):
+    # records the wall time of every run, channel wait and connection setup included
+
+    timings: List[float] = []
+    _timings_lock = threading.Lock()
+
+    def run(self, override_cmds=None) -> TaskResult:
+        start = time.perf_counter()
+        try:
+            return super().run(override_cmds=override_cmds)
+        finally:
+            elapsed = time.perf_counter() - start
+            with TimedTask._timings_lock:
+                TimedTask.timings.append(elapsed)
+
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def build_pipeline(args: Args, network: FakeNetwork) -> SimplePipeline:
+    task_list = []
+    payload = "x" * args.output_size
+    for h in range(args.hosts):
+        host = f"sim-{h:04d}"
+        for i in range(args.tasks_per_host):
+            task_list.append(TimedTask(name=f"task-{h:04d}-{i}", cmd=f"echo {payload}", host=host,
+                                       task_type=TaskType.SHELL))
+    return SimplePipeline(task_list=task_list, concurrency=args.concurrency,
+                          channels_per_host=args.channels_per_host, connection_factory=network)
+
+
+def run_load_test(args: Args) -> Dict[str, object]:
+    network = FakeNetwork(latency=args.latency, bandwidth=args.bandwidth, failure_rate=args.failure_rate,
+                          max_sessions=args.max_sessions, max_startups=args.max_startups, seed=args.seed)
+    pipeline = build_pipeline(args, network)
+    TimedTask.timings = []
+    start = time.perf_counter()
+    try:
+        res = pipeline.run()
+    finally:
+        pipeline.close()
+    elapsed = time.perf_counter() - start
+    ok = sum(1 for r in res.values() if r is not None and r.is_ok)
+    timings = TimedTask.timings
+    peak = network.peak_sessions()
+    return {
+        "hosts": args.hosts,
+        "tasks": pipeline.task_number,
+        "ok": ok,
+        "failed": pipeline.task_number - ok,
+        "elapsed_s": round(elapsed, 4),
+        "throughput_tasks_s": round(pipeline.task_number / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {f"p{p}": round(percentile(timings, p) * 1000, 3) for p in (50, 90, 99)} |
+        {"max": round(max(timings, default=0.0) * 1000, 3)},
+        "peak_sessions_per_host": max(peak.values(), default=0),
+        "network": dict(network.stats),
+    }
+
+
+def write_report(report: Dict[str, object], format: str = "txt"):
+    if format == "json":
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        if isinstance(value, dict):
+            value = ", ".join(f"{k}={v}" for k, v in value.items())
+        print(f"{key}: {value}")
+
+
+def parse_args() -> Args:
+    p: Parser = Parser(description="drive SimplePipeline against simulated ssh hosts")
+    p.add_argument("--hosts", help="number of simulated hosts", type=int, default=200)
+    p.add_argument("--tasks-per-host", help="shell tasks per host", type=int, default=5)
+    p.add_argument("-c", "--concurrency", help="pipeline concurrency", type=int, default=64)
+    p.add_argument("--channels-per-host", help="channel limit per host", type=int, default=4)
+    p.add_argument("--latency", help="round trip time in seconds", type=float, default=0.01)
+    p.add_argument("--bandwidth", help="bytes per second per transfer ( default unlimited )", type=float)
+    p.add_argument("--failure-rate", help="probability of a command failing", type=float, default=0.0)
+    p.add_argument("--max-sessions", help="sessions per host before channels are refused", type=int, default=10)
+    p.add_argument("--max-startups", help="concurrent handshakes per host before they are refused", type=int)
+    p.add_argument("--output-size", help="bytes written by every command", type=int, default=16)
+    p.add_argument("--seed", help="random seed for failures", type=int)
+    p.add_argument("-f", "--format", help="report format", choices=("txt", "json"), default="txt")
+    return p.parse_args()
+
+
+def run_main():
+    args = parse_args()
+    report = run_load_test(args)
+    write_report(report, format=args.format)
+
+
+if __name__ == "__main__":
+    run_main()
@@ -11,3 +11,7 @@ except ImportError:
     sys.path.insert(0, proj_dir)
 from pydepl.task import Task, TaskResult, TaskType
 from pydepl.pipeline import SimplePipeline
+from pydepl.connection import ConnectionPool
+from pydepl.fake_ssh import FakeNetwork, FakeSSHError
+from pydepl.remote_helper import RemoteHelper, RemoteHelperError
+from pydepl.watch import InotifyWatcher, PollingWatcher, get_watcher, watch_pipeline, watched_paths
@@ -0,0 +1,81 @@
+import base64
+import importlib.util
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+B64_SCRIPT = os.path.join(os.path.dirname(__file__), os.path.pardir, "script", "b64.py")
+spec = importlib.util.spec_from_file_location("b64", B64_SCRIPT)
+b64 = importlib.util.module_from_spec(spec)
+# worker processes unpickle the chunk functions by module name
+sys.modules["b64"] = b64
+spec.loader.exec_module(b64)
+
+
+class Test_B64(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.data = os.urandom(100003)
+        tmp = tempfile.NamedTemporaryFile(delete=False)
+        tmp.write(self.data)
+        tmp.close()
+        self.file_name = tmp.name
+        self.addCleanup(os.unlink, self.file_name)
+        return super().setUp()
+
+    def encode(self, fin, **kwargs) -> bytes:
+        out = io.BytesIO()
+        b64.encode_stream(fin, out.write, **kwargs)
+        return out.getvalue()
+
+    def test_encode_unaligned_chunks(self):
+        for chunk_size in (1, 7, 1000, 4096):
+            self.assertEqual(self.encode(io.BytesIO(self.data), chunk_size=chunk_size), base64.b64encode(self.data))
+        self.assertEqual(self.encode(io.BytesIO(self.data), chunk_size=1000, url_variant=True),
+                         base64.urlsafe_b64encode(self.data))
+
+    def test_decode_wrapped_lines(self):
+        # encodebytes wraps every 76 chars, chunks are cut in the middle of lines
+        encoded = base64.encodebytes(self.data)
+        for chunk_size in (5, 1001):
+            out = io.BytesIO()
+            b64.decode_stream(io.BytesIO(encoded), out.write, chunk_size=chunk_size)
+            self.assertEqual(out.getvalue(), self.data)
+        self.assertRaises(b64.binascii.Error, b64.decode_stream, io.BytesIO(b"aGVsbG8"), io.BytesIO().write)
+
+    def test_encode_jobs_mmap(self):
+        expected = base64.b64encode(self.data)
+        fin = b64.open_input(self.file_name, use_mmap=True)
+        try:
+            self.assertEqual(self.encode(fin, chunk_size=1000, jobs=3, file_name=self.file_name), expected)
+            self.assertEqual(self.encode(fin, chunk_size=1000), expected)
+        finally:
+            fin.close()
+        with open(self.file_name, "rb") as fin:
+            self.assertEqual(self.encode(fin, chunk_size=1000, jobs=3), expected)
+
+    def run_script(self, *args, input_data: bytes = None) -> bytes:
+        return subprocess.run([sys.executable, B64_SCRIPT, *args], input=input_data, capture_output=True,
+                              check=True).stdout
+
+    def test_cli(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_file = os.path.join(tmp_dir, "out.txt")
+            self.run_script("-i", self.file_name, "-m", "-j", "2", "-c", "1000", "-o", out_file)
+            with open(out_file, "rb") as fin:
+                self.assertEqual(fin.read().strip(), base64.b64encode(self.data))
+        # the string and the stream mode write the same json object
+        self.assertEqual(json.loads(self.run_script("-f", "json", "hello")), {"base64": "aGVsbG8="})
+        self.assertEqual(json.loads(self.run_script("-f", "json", "-i", "-", input_data=b"hello")),
+                         {"base64": "aGVsbG8="})
+        self.assertEqual(json.loads(self.run_script("-f", "json", "-d", "aGVsbG8=")), {"decoded": "hello"})
+        self.assertEqual(json.loads(self.run_script("-f", "json", "-d", "-i", "-", input_data=b"aGVs\nbG8=\n")),
+                         {"decoded": "hello"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+from context import ConnectionPool
+
+
+class Test_ConnectionPool(unittest.TestCase):
+
+    def test_get_shares_connection(self):
+        pool = ConnectionPool()
+        c1 = pool.get("neo")
+        self.assertIs(pool.get("neo"), c1)
+        self.assertIsNot(pool.get("neo", connection_args={"user": "root"}), c1)
+        self.assertIsNot(pool.get("morpheus"), c1)
+
+    def test_channel_limit(self):
+        pool = ConnectionPool(channels_per_host={"default": 3, "neo": 2})
+        self.assertEqual(pool.channel_limit("neo"), 2)
+        self.assertEqual(pool.channel_limit("morpheus"), 3)
+        self.assertRaises(ValueError, ConnectionPool, 0)
+        conn = MagicMock()
+        conn.host = "neo"
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def use_channel():
+            with pool.channel(conn):
+                with lock:
+                    active.append(1)
+                    peak.append(len(active))
+                time.sleep(0.05)
+                with lock:
+                    active.pop()
+
+        threads = [threading.Thread(target=use_channel) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(max(peak), 2)
+
+    def test_open_once(self):
+        pool = ConnectionPool(channels_per_host=4)
+        conn = MagicMock()
+        conn.host = "neo"
+        conn.is_connected = False
+
+        def slow_open():
+            time.sleep(0.05)
+            conn.is_connected = True
+
+        conn.open = MagicMock(side_effect=slow_open)
+
+        def use_channel():
+            with pool.channel(conn):
+                pass
+
+        threads = [threading.Thread(target=use_channel) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(conn.open.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+from context import FakeNetwork, FakeSSHError, SimplePipeline, Task, TaskType
+
+
+class Test_FakeSSH(unittest.TestCase):
+
+    def build_pipeline(self, network, hosts=100, tasks_per_host=3, **pipeline_args):
+        task_list = [Task(name=f"task-{h}-{i}", cmd=f"echo {h}-{i}", host=f"sim-{h}")
+                     for h in range(hosts) for i in range(tasks_per_host)]
+        return SimplePipeline(task_list=task_list, connection_factory=network, **pipeline_args)
+
+    def test_many_hosts(self):
+        network = FakeNetwork(latency=0.001)
+        pipeline = self.build_pipeline(network, concurrency=32, channels_per_host=2)
+        res = pipeline.run()
+        self.assertEqual(len(res), 300)
+        self.assertTrue(all(r.is_ok for r in res.values()))
+        self.assertEqual(res["task-42-1"].stdout.strip(), "42-1")
+        # one handshake per host, one channel per command
+        self.assertEqual(network.stats["handshakes"], 100)
+        self.assertEqual(network.stats["channels"], 300)
+        self.assertLessEqual(max(network.peak_sessions().values()), 2)
+
+    def test_session_limit(self):
+        network = FakeNetwork(latency=0.005, max_sessions=2)
+        pipeline = self.build_pipeline(network, hosts=2, tasks_per_host=6, concurrency=12, channels_per_host=6)
+        res = pipeline.run()
+        self.assertGreater(network.stats["rejected"], 0)
+        self.assertLess(len(res), 12)
+
+    def test_failure_rate(self):
+        network = FakeNetwork(failure_rate=1.0)
+        conn = network(host="sim-0")
+        self.assertRaises(FakeSSHError, conn.run, "echo hello")
+        self.assertEqual(network.stats["failures"], 1)
+        self.assertRaises(ValueError, FakeNetwork, failure_rate=2)
+
+    def test_scp(self):
+        network = FakeNetwork()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src = os.path.join(tmp_dir, "conf.txt")
+            with open(src, "w") as fout:
+                fout.write("hello")
+            put = Task(name="put", cmd=src, host="localhost", dest="sim-0", task_type=TaskType.SCP)
+            pipeline = SimplePipeline(task_list=[put], connection_factory=network)
+            res = pipeline.run()
+            self.assertTrue(res["put"].is_ok)
+            self.assertEqual(network.host_state("sim-0").files[src], b"hello")
+            self.assertEqual(network.host_state("localhost").files, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
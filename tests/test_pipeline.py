@@ -1,10 +1,20 @@
 import unittest
+from unittest import mock
 from context import SimplePipeline
 from io import StringIO
+import shutil
+import tempfile
 
 
 class Test_Pipeline(unittest.TestCase):
 
+    def setUp(self) -> None:
+        # invoke forwards stdin to local commands, pytest does not allow reading it while capturing
+        patcher = mock.patch("sys.stdin", StringIO())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return super().setUp()
+
     def test_from_file_yaml(self):
         yaml_data = u"""
         version: 1
@@ -35,6 +45,367 @@ class Test_Pipeline(unittest.TestCase):
             initial_value=yaml_data).read(), file_type="yaml")
         self.assertEqual(pipeline.task_number, 1)
 
+    def test_downstream_of(self):
+        yaml_data = u"""
+        version: 1
+        context:
+            my-host: localhost
+        task_list:
+            - task:
+                task_name: task1
+                host: "{my-host}"
+                type: shellout
+                out_var: file_name
+                cmd: echo "prova"
+            - task:
+                task_name: task2
+                host: "{my-host}"
+                type: shell
+                cmd: echo "hello"
+            - task:
+                task_name: task3
+                host: "{my-host}"
+                type: shell
+                cmd: echo "{file_name}"
+        """
+        pipeline = SimplePipeline.from_file(file_data=yaml_data, file_type="yaml")
+        self.assertEqual(pipeline.downstream_of(["task1"]), {"task1", "task3"})
+        self.assertEqual(pipeline.downstream_of(["task2"]), {"task2"})
+        self.assertEqual(pipeline.downstream_of([]), set())
+
+    def test_update_from(self):
+        yaml_data = u"""
+        version: 1
+        context:
+            my-host: localhost
+        task_list:
+            - task:
+                task_name: task1
+                host: "{my-host}"
+                type: shellout
+                out_var: file_name
+                cmd: echo "prova"
+            - task:
+                task_name: task2
+                host: "{my-host}"
+                type: shell
+                cmd: echo "{file_name}"
+            - task:
+                task_name: task3
+                host: "{my-host}"
+                type: shell
+                cmd: echo "hello"
+        """
+        pipeline = SimplePipeline.from_file(file_data=yaml_data, file_type="yaml")
+        reloaded = SimplePipeline.from_file(file_data=yaml_data, file_type="yaml")
+        self.assertEqual(pipeline.update_from(reloaded), set())
+        reloaded = SimplePipeline.from_file(
+            file_data=yaml_data.replace('echo "prova"', 'echo "prova2"'), file_type="yaml")
+        self.assertEqual(pipeline.update_from(reloaded), {"task1", "task2"})
+        reloaded = SimplePipeline.from_file(
+            file_data=yaml_data.replace('my-host: localhost', 'my-host: 127.0.0.1'), file_type="yaml")
+        self.assertEqual(pipeline.update_from(reloaded), {"task1", "task2", "task3"})
+        self.assertEqual(pipeline.task_list[0].host, "127.0.0.1")
+
+    def test_update_from_removed_task_and_settings(self):
+        yaml_data = u"""
+        version: 1
+        context:
+            my-host: localhost
+        task_list:
+            - task:
+                task_name: task1
+                host: "{my-host}"
+                type: shellout
+                out_var: file_name
+                cmd: echo "prova"
+            - task:
+                task_name: task2
+                host: "{my-host}"
+                type: shell
+                cmd: echo "{file_name}"
+            - task:
+                task_name: task3
+                host: "{my-host}"
+                type: shell
+                cmd: echo "hello"
+        """
+        pipeline = SimplePipeline.from_file(file_data=yaml_data, file_type="yaml")
+        pipeline.run()
+        self.assertEqual(pipeline.context["file_name"], "prova")
+        # task1 is removed: its output leaves the context and task2 has to run again
+        without_task1 = yaml_data.replace("task_name: task1", "task_name: task0").replace(
+            "out_var: file_name", "out_var: other")
+        reloaded = SimplePipeline.from_file(file_data=without_task1, file_type="yaml")
+        self.assertEqual(pipeline.update_from(reloaded), {"task0", "task2"})
+        self.assertNotIn("file_name", pipeline.context)
+        old_pool = pipeline.task_list[0].connection_pool
+        reloaded = SimplePipeline.from_file(
+            file_data=without_task1.replace("version: 1", "version: 1\n        channels_per_host: 3\n"
+                                            "        remote_helper: true"), file_type="yaml")
+        self.assertEqual(pipeline.update_from(reloaded), set())
+        pool = pipeline.task_list[0].connection_pool
+        self.assertIsNot(pool, old_pool)
+        self.assertTrue(all(t.connection_pool is pool for t in pipeline.task_list))
+        self.assertEqual(pool.channel_limit("neo"), 3)
+        self.assertTrue(pool.remote_helper)
+
+    def test_run_only(self):
+        yaml_data = u"""
+        version: 1
+        context:
+            my-host: localhost
+        task_list:
+            - task:
+                task_name: task1
+                host: "{my-host}"
+                type: shellout
+                out_var: file_name
+                cmd: echo "prova"
+            - task:
+                task_name: task2
+                host: "{my-host}"
+                type: shell
+                cmd: cat TMP_FILE
+            - task:
+                task_name: task3
+                host: "{my-host}"
+                type: shell
+                cmd: echo "{file_name}"
+        """
+        with tempfile.NamedTemporaryFile(suffix=".txt") as tmp:
+            pipeline = SimplePipeline.from_file(
+                file_data=yaml_data.replace("TMP_FILE", tmp.name), file_type="yaml")
+            res = pipeline.run(only=["task1"])
+            self.assertEqual(list(res), ["task1"])
+            self.assertEqual(pipeline.context["file_name"], "prova")
+            first = res["task1"]
+            res = pipeline.run(only=["task2", "task3"])
+            self.assertIs(res["task1"], first)
+            self.assertTrue(res["task2"].is_ok)
+            self.assertEqual(res["task3"].stdout.strip(), "prova")
+            self.assertEqual(pipeline.affected_by([tmp.name]), {"task2"})
+            self.assertEqual(pipeline.affected_by(["missing.txt"]), set())
+
+    def test_run_concurrent(self):
+        yaml_data = u"""
+        version: 1
+        concurrency: 4
+        channels_per_host: 2
+        context:
+            my-host: localhost
+        task_list:
+            - task:
+                task_name: task1
+                host: "{my-host}"
+                type: shellout
+                out_var: file_name
+                cmd: touch TMP_DIR/task1 && WAIT_FOR TMP_DIR/task2 && echo "prova"
+            - task:
+                task_name: task2
+                host: "{my-host}"
+                type: shellout
+                out_var: other
+                cmd: touch TMP_DIR/task2 && WAIT_FOR TMP_DIR/task1 && echo "other"
+            - task:
+                task_name: task3
+                host: "{my-host}"
+                type: shell
+                cmd: echo "{file_name} {other}"
+            - task:
+                task_name: task4
+                host: "{my-host}"
+                type: shell
+                depends_on: task3
+                cmd: echo "done"
+        """
+        # task1 and task2 can only succeed if each one sees the file touched by the other while it is running
+        wait_for = "for i in $(seq 100); do test -e WAIT_PATH && break; sleep 0.1; done; test -e WAIT_PATH"
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        for name in ("task1", "task2"):
+            yaml_data = yaml_data.replace(f"WAIT_FOR TMP_DIR/{name}", wait_for.replace("WAIT_PATH", f"TMP_DIR/{name}"))
+        yaml_data = yaml_data.replace("TMP_DIR", tmp_dir)
+        pipeline = SimplePipeline.from_file(file_data=yaml_data, file_type="yaml")
+        self.assertEqual(pipeline.concurrency, 4)
+        self.assertEqual(pipeline.dependencies(pipeline.task_list),
+                         {"task1": set(), "task2": set(), "task3": {"task1", "task2"}, "task4": {"task3"}})
+        self.assertEqual(pipeline.downstream_of(["task2"]), {"task2", "task3", "task4"})
+        res = pipeline.run()
+        self.assertTrue(res["task1"].is_ok and res["task2"].is_ok)
+        self.assertEqual(res["task3"].stdout.strip(), "prova other")
+        self.assertTrue(res["task4"].is_ok)
+
+    def test_matrix(self):
+        yaml_data = u"""
+        version: 1
+        context:
+            my-host: localhost
+            env: prod
+        task_list:
+            - task:
+                task_name: deploy
+                host: "{my-host}"
+                type: shellout
+                out_var: deployed
+                matrix:
+                    service: [api, web]
+                    shard: 2
+                options:
+                    matrix_parallel: 3
+                cmd: echo "{env}-{service}-{shard}"
+            - task:
+                task_name: report
+                host: "{my-host}"
+                type: shell
+                cmd: echo "{deployed[service=web,shard=1]}"
+        """
+        pipeline = SimplePipeline.from_file(file_data=yaml_data, file_type="yaml")
+        self.assertEqual(pipeline.task_number, 2)
+        deploy = pipeline.task_list[0]
+        self.assertTrue(deploy.is_matrix)
+        self.assertEqual(deploy.matrix_size(), 4)
+        instances = deploy.expand()
+        first = next(instances)
+        self.assertEqual(first.name, "deploy[service=api,shard=0]")
+        self.assertFalse(first.is_matrix)
+        self.assertEqual(first.formatted_cmd(with_context={"env": "dev", "service": "x"}), 'echo "dev-api-0"')
+        res = pipeline.run()
+        self.assertEqual(sorted(k for k in res if k.startswith("deploy[")),
+                         ["deploy[service=api,shard=0]", "deploy[service=api,shard=1]",
+                          "deploy[service=web,shard=0]", "deploy[service=web,shard=1]"])
+        self.assertEqual(res["deploy[service=api,shard=1]"].stdout.strip(), "prod-api-1")
+        self.assertEqual(pipeline.context["deployed"]["service=web,shard=0"], "prod-web-0")
+        self.assertEqual(res["report"].stdout.strip(), "prod-web-1")
+
+    def test_matrix_concurrent(self):
+        yaml_data = u"""
+        version: 1
+        concurrency: 4
+        context:
+            my-host: localhost
+        task_list:
+            - task:
+                task_name: deploy
+                host: "{my-host}"
+                type: shellout
+                out_var: deployed
+                matrix: [api, web]
+                cmd: sleep 0.2 && echo "{item}-ok"
+            - task:
+                task_name: count
+                host: "{my-host}"
+                type: shellout
+                out_var: counted
+                matrix: 3
+                cmd: echo "{item}"
+            - task:
+                task_name: report
+                host: "{my-host}"
+                type: shell
+                cmd: echo "{deployed[web]} {counted[2]}"
+        """
+        pipeline = SimplePipeline.from_file(file_data=yaml_data, file_type="yaml")
+        report = pipeline.task_list[2]
+        self.assertEqual(report.referenced_vars(), {"deployed", "counted"})
+        self.assertEqual(pipeline.dependencies(pipeline.task_list)["report"], {"deploy", "count"})
+        self.assertEqual(pipeline.downstream_of(["deploy"]), {"deploy", "report"})
+        self.assertEqual(pipeline.task_list[1].matrix_size(), 3)
+        res = pipeline.run()
+        self.assertEqual(res["count[1]"].stdout.strip(), "1")
+        self.assertEqual(res["report"].stdout.strip(), "web-ok 2")
+
+    def test_matrix_shrinks(self):
+        yaml_data = u"""
+        version: 1
+        context:
+            my-host: localhost
+        task_list:
+            - task:
+                task_name: deploy
+                host: "{my-host}"
+                type: shellout
+                out_var: deployed
+                matrix: [a, b, c]
+                cmd: echo "{item}-ok"
+        """
+        pipeline = SimplePipeline.from_file(file_data=yaml_data, file_type="yaml")
+        res = pipeline.run()
+        self.assertEqual(sorted(res), ["deploy[a]", "deploy[b]", "deploy[c]"])
+        reloaded = SimplePipeline.from_file(file_data=yaml_data.replace("[a, b, c]", "[a, b]"), file_type="yaml")
+        affected = pipeline.update_from(reloaded)
+        self.assertEqual(affected, {"deploy"})
+        res = pipeline.run(only=affected)
+        self.assertEqual(sorted(res), ["deploy[a]", "deploy[b]"])
+        self.assertEqual(pipeline.context["deployed"], {"a": "a-ok", "b": "b-ok"})
+
+    def test_matrix_exit_on_error(self):
+        yaml_data = u"""
+        version: 1
+        concurrency: CONCURRENCY
+        context:
+            my-host: localhost
+        task_list:
+            - task:
+                task_name: deploy
+                host: "{my-host}"
+                type: shell
+                matrix: [1, 2, 3, 4]
+                options:
+                    matrix_parallel: 1
+                cmd: test {item} != 2
+            - task:
+                task_name: after
+                host: "{my-host}"
+                type: shell
+                depends_on: deploy
+                cmd: echo "done"
+        """
+        for concurrency in (1, 2):
+            data = yaml_data.replace("CONCURRENCY", str(concurrency))
+            pipeline = SimplePipeline.from_file(file_data=data, file_type="yaml")
+            res = pipeline.run(exit_on_error=True)
+            self.assertEqual(sorted(res), ["deploy[1]"])
+            pipeline = SimplePipeline.from_file(file_data=data, file_type="yaml")
+            res = pipeline.run()
+            self.assertEqual(sorted(res), ["after", "deploy[1]", "deploy[3]", "deploy[4]"])
+
+    def test_matrix_empty(self):
+        yaml_data = u"""
+        version: 1
+        context:
+            my-host: localhost
+        task_list:
+            - task:
+                task_name: a
+                host: "{my-host}"
+                type: shellout
+                out_var: v
+                matrix: []
+                cmd: echo "item={item}"
+            - task:
+                task_name: b
+                host: "{my-host}"
+                type: shellout
+                out_var: w
+                matrix: 0
+                cmd: echo "item={item}"
+            - task:
+                task_name: c
+                host: "{my-host}"
+                type: shell
+                cmd: echo "done"
+        """
+        pipeline = SimplePipeline.from_file(file_data=yaml_data, file_type="yaml")
+        for t in pipeline.task_list[:2]:
+            self.assertTrue(t.is_matrix)
+            self.assertEqual(t.matrix_size(), 0)
+            self.assertEqual(list(t.expand()), [])
+        res = pipeline.run()
+        self.assertEqual(list(res), ["c"])
+        self.assertEqual(pipeline.context["v"], {})
+        self.assertEqual(pipeline.context["w"], {})
+
 
 if __name__ == "__main__":
     unittest.main()
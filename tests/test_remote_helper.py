@@ -0,0 +1,193 @@
+import os
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+from io import BytesIO
+from unittest.mock import MagicMock
+from invoke.exceptions import UnexpectedExit
+from context import ConnectionPool, FakeNetwork, RemoteHelper, RemoteHelperError, Task, TaskType
+
+
+class Test_RemoteHelper(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.helper = RemoteHelper.local()
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.helper.close()
+        return super().tearDown()
+
+    def test_run(self):
+        res = self.helper.run("echo $GREETING world", env={"GREETING": "hello"})
+        self.assertEqual(res.stdout, "hello world\n")
+        self.assertTrue(res.ok)
+        self.assertRaises(UnexpectedExit, self.helper.run, "exit 3")
+        self.assertEqual(self.helper.run("echo err >&2; exit 3", warn=True).stderr, "err\n")
+
+    def test_concurrent_run(self):
+        out = {}
+
+        def run(i):
+            out[i] = self.helper.run(f"sleep 0.1; echo {i}").stdout.strip()
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(out, {i: str(i) for i in range(10)})
+
+    def test_put_get(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src = os.path.join(tmp_dir, "src.txt")
+            with open(src, "w") as fout:
+                fout.write("hello")
+            os.chmod(src, 0o600)
+            dest = os.path.join(tmp_dir, "dest.txt")
+            res = self.helper.put(local=src, remote=dest)
+            self.assertEqual(res.remote, dest)
+            self.assertEqual(os.stat(dest).st_mode & 0o777, 0o600)
+            copy = os.path.join(tmp_dir, "sub", "copy.txt")
+            self.helper.get(remote=dest, local=copy)
+            with open(copy) as fin:
+                self.assertEqual(fin.read(), "hello")
+            self.assertIsNone(self.helper.get(remote=dest, local=copy, max_size=1))
+            self.assertRaises(RemoteHelperError, self.helper.get, remote=os.path.join(tmp_dir, "missing"), local=copy)
+
+    def test_task_with_helper(self):
+        started = []
+
+        def helper_factory(conn):
+            started.append(conn.host)
+            return self.helper
+
+        pool = ConnectionPool(remote_helper=True, helper_factory=helper_factory)
+        pool._ensure_open = lambda conn: None
+        tasks = [Task(name=f"task{i}", cmd=f"echo {i}", host="neo", task_type=TaskType.SHELLOUT, out_var="out")
+                 for i in range(3)]
+        for t in tasks:
+            t.connection_pool = pool
+        self.assertEqual([t.run().get_out_var("out", None) for t in tasks], ["0", "1", "2"])
+        self.assertEqual(started, ["neo"])
+
+    def test_helper_takes_a_channel_slot(self):
+        pool = ConnectionPool(channels_per_host=3, remote_helper=True, helper_factory=lambda conn: self.helper)
+        conn = pool.get("neo")
+        self.assertIs(pool.helper(conn), self.helper)
+        self.assertIs(pool.helper(conn), self.helper)
+        self.assertEqual(pool._limiter("neo").limit, 2)
+
+    def test_startup_failure_falls_back(self):
+        calls = []
+
+        def failing_factory(conn):
+            calls.append(conn.host)
+            raise RemoteHelperError("python3: command not found")
+
+        network = FakeNetwork()
+        pool = ConnectionPool(connection_factory=network, remote_helper=True, helper_factory=failing_factory)
+        tasks = [Task(name=f"task{i}", cmd=f"echo {i}", host="sim-0") for i in range(3)]
+        for t in tasks:
+            t.connection_pool = pool
+        self.assertEqual([t.run().stdout.strip() for t in tasks], ["0", "1", "2"])
+        # the failure is remembered, later tasks do not retry the startup
+        self.assertEqual(calls, ["sim-0"])
+        self.assertEqual(network.stats["channels"], 3)
+        self.assertEqual(pool._limiter("sim-0").limit, 10)
+
+    def test_helper_dies_falls_back(self):
+        network = FakeNetwork()
+        pool = ConnectionPool(connection_factory=network, remote_helper=True, helper_factory=lambda conn: self.helper)
+        tasks = [Task(name=f"task{i}", cmd=f"echo {i}", host="sim-0") for i in range(3)]
+        for t in tasks:
+            t.connection_pool = pool
+        self.assertEqual(tasks[0].run().stdout.strip(), "0")
+        self.assertEqual(network.stats["channels"], 0)
+        self.assertEqual(pool._limiter("sim-0").limit, 9)
+        # the helper process is killed while a task is waiting for its command
+        running = Task(name="running", cmd="sleep 5", host="sim-0")
+        running.connection_pool = pool
+        errors = []
+
+        def run():
+            try:
+                running.run()
+            except RemoteHelperError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        deadline = time.monotonic() + 10
+        while not self.helper._pending and time.monotonic() < deadline:
+            time.sleep(0.01)
+        os.kill(self.helper.pid, signal.SIGKILL)
+        thread.join(timeout=10)
+        self.helper._reader_thread.join(timeout=10)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(self.helper.is_closed)
+        # later tasks run over their own channels and the helper slot is given back
+        self.assertEqual([t.run().stdout.strip() for t in tasks[1:]], ["1", "2"])
+        self.assertEqual(network.stats["channels"], 2)
+        self.assertIsNone(pool.helper(pool.get("sim-0")))
+        self.assertEqual(pool._limiter("sim-0").limit, 10)
+
+    def test_over_ssh_closes_channel(self):
+        conn = MagicMock()
+        conn.is_connected = True
+        chan = conn.client.get_transport.return_value.open_session.return_value
+        # the remote python is missing: the channel is closed without the ready frame
+        chan.makefile.return_value = BytesIO(b"")
+        chan.makefile_stdin.return_value = BytesIO()
+        chan.recv_stderr_ready.return_value = True
+        chan.makefile_stderr.return_value = BytesIO(b"sh: 1: python3: not found")
+        with self.assertRaises(RemoteHelperError) as ctx:
+            RemoteHelper.over_ssh(conn)
+        self.assertIn("python3: not found", str(ctx.exception))
+        chan.close.assert_called_once()
+
+    def test_over_ssh_rejects_garbage_before_ready(self):
+        conn = MagicMock()
+        conn.is_connected = True
+        chan = conn.client.get_transport.return_value.open_session.return_value
+        # a login script printing a banner: "Welc" would be read as a frame of about 1.4GB
+        chan.makefile.return_value = BytesIO(b"Welcome to neo\n" + bytes(64))
+        chan.makefile_stdin.return_value = BytesIO()
+        chan.recv_stderr_ready.return_value = False
+        self.assertRaises(RemoteHelperError, RemoteHelper.over_ssh, conn, startup_timeout=5)
+        chan.settimeout.assert_called_once_with(5)
+        chan.close.assert_called_once()
+
+    def test_over_ssh_startup_timeout(self):
+        conn = MagicMock()
+        conn.is_connected = True
+        chan = conn.client.get_transport.return_value.open_session.return_value
+        chan.makefile.return_value.read.side_effect = socket.timeout("timed out")
+        chan.makefile_stdin.return_value = BytesIO()
+        with self.assertRaises(RemoteHelperError) as ctx:
+            RemoteHelper.over_ssh(conn)
+        self.assertIn("timed out", str(ctx.exception))
+        chan.close.assert_called_once()
+
+    def test_failed_write_does_not_leak(self):
+        read_fd, write_fd = os.pipe()
+        ready = b'{"id": 0, "ready": true, "pid": 1}'
+        os.write(write_fd, struct.pack(">I", len(ready)) + ready)
+        writer = MagicMock()
+        # the helper source goes through, then the channel breaks
+        writer.write.side_effect = [None, BrokenPipeError("broken pipe")]
+        with os.fdopen(read_fd, "rb") as reader:
+            helper = RemoteHelper(reader=reader, writer=writer)
+            self.assertRaises(RemoteHelperError, helper.run, "echo hello")
+            self.assertEqual(helper._pending, {})
+            os.close(write_fd)
+            helper._reader_thread.join(timeout=10)
+        self.assertTrue(helper.is_closed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import unittest
+from io import StringIO
+from unittest import mock
+from context import InotifyWatcher, PollingWatcher, SimplePipeline, get_watcher, watch_pipeline, watched_paths
+
+
+def write(path: str, data: str, mtime_ns: int = None):
+    with open(path, "w") as fout:
+        fout.write(data)
+    if mtime_ns is not None:
+        # coarse filesystem timestamps could hide a change made in the same tick
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def replace(path: str, data: str, mtime_ns: int = None):
+    # editors write a new file and rename it over the old one
+    tmp = path + ".swp"
+    write(tmp, data, mtime_ns=mtime_ns)
+    os.replace(tmp, path)
+
+
+class Test_Watch(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, "input.txt")
+        write(self.path, "one", mtime_ns=10 ** 18)
+        return super().setUp()
+
+    def test_polling(self):
+        watcher = PollingWatcher(interval=0.01)
+        self.addCleanup(watcher.close)
+        watcher.set_paths([self.path])
+        self.assertEqual(watcher.wait(timeout=0.05), set())
+        write(self.path, "two", mtime_ns=10 ** 18 + 1)
+        self.assertEqual(watcher.wait(timeout=1), {self.path})
+        self.assertEqual(watcher.wait(timeout=0.05), set())
+        replace(self.path, "three", mtime_ns=10 ** 18 + 2)
+        self.assertEqual(watcher.wait(timeout=1), {self.path})
+
+    def test_polling_change_during_run(self):
+        watcher = PollingWatcher(interval=0.01)
+        self.addCleanup(watcher.close)
+        watcher.set_paths([self.path])
+        # saved while the pipeline runs, set_paths is called again after the run
+        write(self.path, "two", mtime_ns=10 ** 18 + 1)
+        watcher.set_paths([self.path])
+        self.assertEqual(watcher.wait(timeout=1), {self.path})
+
+    def test_inotify(self):
+        watcher = get_watcher()
+        self.addCleanup(watcher.close)
+        if not isinstance(watcher, InotifyWatcher):
+            self.skipTest("inotify is not available")
+        watcher.set_paths([self.path])
+        self.assertEqual(watcher.wait(timeout=0.05), set())
+        write(self.path, "two")
+        self.assertEqual(watcher.wait(timeout=1), {self.path})
+        replace(self.path, "three")
+        self.assertEqual(watcher.wait(timeout=1), {self.path})
+        # other files in the watched directory are ignored
+        write(os.path.join(self.tmp_dir, "other.txt"), "other")
+        self.assertEqual(watcher.wait(timeout=0.2), set())
+
+    def test_watch_pipeline(self):
+        yaml_data = u"""
+        version: 1
+        context:
+            my-host: localhost
+        task_list:
+            - task:
+                task_name: read
+                host: "{my-host}"
+                type: shellout
+                out_var: content
+                cmd: cat INPUT
+            - task:
+                task_name: report
+                host: "{my-host}"
+                type: shell
+                cmd: echo "{content}"
+            - task:
+                task_name: other
+                host: "{my-host}"
+                type: shell
+                cmd: echo "other"
+        """.replace("INPUT", self.path)
+        file_name = os.path.join(self.tmp_dir, "pipeline.yaml")
+        write(file_name, yaml_data)
+        pipeline = SimplePipeline.from_file(file_name=file_name)
+        watcher = PollingWatcher(interval=0.01)
+        reruns = []
+        run = pipeline.run
+
+        def wait(timeout=None):
+            if reruns:
+                raise KeyboardInterrupt()
+            self.assertEqual(watched_paths(pipeline, file_name), sorted([file_name, self.path]))
+            write(self.path, "two", mtime_ns=10 ** 18 + 1)
+            return PollingWatcher.wait(watcher, timeout=1)
+
+        def run_and_record(exit_on_error=False, only=None):
+            if only is not None:
+                reruns.append(set(only))
+            return run(exit_on_error=exit_on_error, only=only)
+
+        watcher.wait = wait
+        pipeline.run = run_and_record
+        with mock.patch("sys.stdin", StringIO()), mock.patch("pydepl.watch.get_watcher", return_value=watcher):
+            watch_pipeline(pipeline, file_name=file_name)
+        self.assertEqual(reruns, [{"read", "report"}])
+        self.assertEqual(pipeline.context["content"], "two")
+
+
+if __name__ == "__main__":
+    unittest.main()